@@ -6,25 +6,37 @@ import os
 import sys
 import io
 import random
-import base64
+import binascii
 import hashlib
+import heapq
+import hmac
+import time
 import asyncio
+import concurrent.futures
+import functools
 import logging
 import json
 import signal
+import socket
+import sqlite3
+import threading
+import urllib.parse
 import html
+import re
+from collections import OrderedDict
 from pathlib import Path
 from datetime import datetime, timedelta
-from typing import Dict, Tuple, Optional
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Tuple, Optional
 
 # --- aiohttp для асинхронных HTTP-запросов ---
 import aiohttp
+from aiohttp import web
 
 # --- Парсинг HTML-страниц ---
 try:
-    from bs4 import BeautifulSoup
+    from lxml import etree
 except ImportError:
-    sys.exit("Библиотека BeautifulSoup4 не установлена. pip install beautifulsoup4 lxml")
+    sys.exit("Библиотека lxml не установлена. pip install lxml")
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -35,13 +47,17 @@ from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.types import (
     InlineKeyboardMarkup, InlineKeyboardButton,
     InputTextMessageContent, InlineQueryResultArticle,
     BufferedInputFile, ChatMemberUpdated, TextQuote,
     BotCommand, BotCommandScopeDefault
 )
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 
 # ─────────── Базовая настройка ───────────
 logging.basicConfig(
@@ -73,6 +89,20 @@ def get_secret(name: str, default: str = None) -> str:
     return value or default
 
 
+def get_config(name: str, default, cast=int):
+    """Читает числовую/строковую настройку из переменной окружения."""
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    try:
+        if cast is bool:
+            return value.strip().lower() in ("1", "true", "yes", "on")
+        return cast(value)
+    except ValueError:
+        log.warning(f"Некорректное значение {name}={value!r}, используется {default!r}")
+        return default
+
+
 # ─────────── Загрузка конфигурации ───────────
 API_TOKEN = get_secret("psi_chat_bot")
 GEMINI_API_KEY = get_secret("GEMINI_API_KEY")
@@ -101,12 +131,35 @@ else:
 DATA_DIR = Path("/app/data") if os.path.exists("/app") else Path("./data")
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 
+# Устаревшие файлы: импортируются в хранилище состояния при первом запуске
 CACHE_FILE = DATA_DIR / "cache.json"
 API_USAGE_FILE = DATA_DIR / "api_usage.json"
+STATE_DB_FILE = DATA_DIR / "state.sqlite3"
+PAGE_CACHE_FILE = DATA_DIR / "pages.sqlite3"
+
+# ─────────── Режим работы ───────────
+# polling — long polling; webhook — встроенный aiohttp-сервер
+BOT_MODE = get_config("BOT_MODE", "polling", str).lower()
+WEBHOOK_URL = get_config("WEBHOOK_URL", "", str)  # Публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = get_config("WEBHOOK_PATH", "/webhook", str)
+WEBHOOK_HOST = get_config("WEBHOOK_HOST", "0.0.0.0", str)
+WEBHOOK_PORT = get_config("WEBHOOK_PORT", 8080)
+WEBHOOK_SECRET = (
+    get_secret("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{API_TOKEN}".encode()).hexdigest()
+)
+WEBHOOK_REUSE_PORT = get_config("WEBHOOK_REUSE_PORT", False, bool)
+# Сколько ждать обработки уже принятых обновлений при остановке, с
+WEBHOOK_DRAIN_TIMEOUT = get_config("WEBHOOK_DRAIN_TIMEOUT", 30.0, float)
+# Свой Bot API сервер (локальный telegram-bot-api или заглушка для тестов)
+TELEGRAM_API_URL = get_config("TELEGRAM_API_URL", "", str)
+
+if BOT_MODE == "webhook" and not WEBHOOK_URL:
+    sys.exit("❌ BOT_MODE=webhook требует WEBHOOK_URL")
 
 # ─────────── Инициализация бота ───────────
 bot = Bot(
     token=API_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
 dp = Dispatcher()
@@ -114,46 +167,1327 @@ BOT_USERNAME = ""
 
 # ─────────── Константы ───────────
 SEARCH_API_DAILY_LIMIT = 100
+
+# Квоты Gemini: запросов в минуту (token bucket) и в сутки (сброс в полночь UTC), 0 — без лимита
+GEMINI_TEXT_RPM = get_config("GEMINI_TEXT_RPM", 15)
+GEMINI_TEXT_RPD = get_config("GEMINI_TEXT_RPD", 1500)
+GEMINI_IMAGE_RPM = get_config("GEMINI_IMAGE_RPM", 10)
+GEMINI_IMAGE_RPD = get_config("GEMINI_IMAGE_RPD", 1000)
+
+# /proof: сколько текста брать с каждой страницы и сколько максимум скачивать
+PROOF_SOURCE_CHARS = 1500
+PROOF_PAGE_MAX_BYTES = get_config("PROOF_PAGE_MAX_BYTES", 1024 * 1024)
+PROOF_PAGE_CHUNK = 16 * 1024
+
+# Кэш /proof: готовые ответы и выдача поиска живут недолго (dateRestrict=d1),
+# очищенный запрос от времени не зависит
+PROOF_CACHE_TTL = get_config("PROOF_CACHE_TTL", 3600)
+PROOF_QUERY_CACHE_TTL = get_config("PROOF_QUERY_CACHE_TTL", 6 * 3600)
+PROOF_CACHE_MAX_ENTRIES = get_config("PROOF_CACHE_MAX_ENTRIES", 2000)
+
+# Кэш текста страниц: свежие записи отдаются без запроса, устаревшие перепроверяются
+# по ETag/Last-Modified; неудачные URL какое-то время не запрашиваются вовсе
+PAGE_CACHE_MAX_BYTES = get_config("PAGE_CACHE_MAX_BYTES", 32 * 1024 * 1024)
+PAGE_CACHE_FRESH = get_config("PAGE_CACHE_FRESH", 900)
+PAGE_FAIL_TTL = get_config("PAGE_FAIL_TTL", 300)
+
+# Потоковый ответ /proof: частичный текст показывается правкой сообщения не чаще,
+# чем раз в PROOF_STREAM_EDIT_INTERVAL секунд (Telegram ограничивает частоту правок)
+PROOF_STREAM = get_config("PROOF_STREAM", True, bool)
+PROOF_STREAM_EDIT_INTERVAL = get_config("PROOF_STREAM_EDIT_INTERVAL", 1.5, float)
+
+# Бюджет времени /proof: общий срок, лимиты этапов и резерв под ответ Gemini.
+# Через PROOF_HEDGE_AFTER секунд ответ начинается с уже загруженными страницами
+PROOF_DEADLINE = get_config("PROOF_DEADLINE", 60.0, float)
+PROOF_QUERY_BUDGET = get_config("PROOF_QUERY_BUDGET", 5.0, float)
+PROOF_SEARCH_BUDGET = get_config("PROOF_SEARCH_BUDGET", 8.0, float)
+PROOF_FETCH_BUDGET = get_config("PROOF_FETCH_BUDGET", 8.0, float)
+PROOF_HEDGE_AFTER = get_config("PROOF_HEDGE_AFTER", 3.0, float)
+PROOF_SUMMARY_RESERVE = get_config("PROOF_SUMMARY_RESERVE", 25.0, float)
 TTL = timedelta(hours=6)
 TTL_SECONDS = int(TTL.total_seconds())
 
-# Locks для потокобезопасности
-api_usage_lock = asyncio.Lock()
-cache_lock = asyncio.Lock()
+# HTTP-пул: одна сессия на процесс для Gemini, Google Search, страниц и загрузки
+HTTP_POOL_LIMIT = get_config("HTTP_POOL_LIMIT", 100)
+HTTP_POOL_LIMIT_PER_HOST = get_config("HTTP_POOL_LIMIT_PER_HOST", 20)
+HTTP_KEEPALIVE_TIMEOUT = get_config("HTTP_KEEPALIVE_TIMEOUT", 60.0, float)
+HTTP_DNS_CACHE_TTL = get_config("HTTP_DNS_CACHE_TTL", 300)
+HTTP_CONNECT_TIMEOUT = get_config("HTTP_CONNECT_TIMEOUT", 5.0, float)
+HTTP_TOTAL_TIMEOUT = get_config("HTTP_TOTAL_TIMEOUT", 60.0, float)
+
+# Генерация значений: random (случайные, с кэшем) или hash (детерминированные, без состояния)
+STATS_MODE = get_config("STATS_MODE", "random", str).lower()
+STATS_SECRET = (
+    get_secret("STATS_SECRET") or hashlib.sha256(f"stats:{API_TOKEN}".encode()).hexdigest()
+).encode()
+
+# Лимиты кэшей в памяти
+IMG_CACHE_MAX_BYTES = get_config("IMG_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+STATS_CACHE_MAX_ENTRIES = get_config("STATS_CACHE_MAX_ENTRIES", 200_000)
+CACHE_SWEEP_INTERVAL = get_config("CACHE_SWEEP_INTERVAL", 60)
+
+# Устаревшие значения и аватар отдаются ещё STALE_GRACE секунд после конца окна,
+# пока в фоне готовится новое (0 — выключено). TTL_JITTER — доля TTL, на которую
+# случайно сдвигается конец окна, чтобы пользователи не истекали одновременно
+STALE_GRACE = get_config("STALE_GRACE", 0)
+TTL_JITTER = get_config("TTL_JITTER", 0.0, float)
+INLINE_CACHE_MAX_ENTRIES = get_config("INLINE_CACHE_MAX_ENTRIES", 50_000)
+
+# Хранилище состояния: sqlite (WAL) или memory
+STATE_BACKEND = get_config("STATE_BACKEND", "sqlite", str).lower()
+STATE_COMPACT_INTERVAL = get_config("STATE_COMPACT_INTERVAL", 3600)
+
+# Общее состояние для нескольких воркеров (redis://[:password@]host:port/db)
+STATE_REDIS_URL = get_secret("STATE_REDIS_URL")
+# Сколько воркер ждёт аватар, который генерирует другой воркер, с
+AVATAR_FLIGHT_TTL = get_config("AVATAR_FLIGHT_TTL", 90.0, float)
+AVATAR_FLIGHT_POLL = get_config("AVATAR_FLIGHT_POLL", 0.5, float)
+
+# Фоновая генерация аватаров: одновременных генераций, длина очереди и с какой
+# позиции в очереди пользователю показывается сообщение «в очереди»
+AVATAR_WORKERS = get_config("AVATAR_WORKERS", 4)
+AVATAR_QUEUE_MAX = get_config("AVATAR_QUEUE_MAX", 100)
+AVATAR_QUEUE_NOTICE = get_config("AVATAR_QUEUE_NOTICE", 1)
+
+# Предзагрузка: за PREFETCH_LEAD секунд до конца окна активным пользователям заранее
+# готовятся значения и аватар следующего окна (0 — выключено). На это уходит не
+# больше PREFETCH_SHARE дневной квоты изображений и не больше PREFETCH_MAX_PER_ROUND
+# генераций за проход; PREFETCH_RESERVE вызовов в минуту остаётся интерактивным запросам
+PREFETCH_LEAD = get_config("PREFETCH_LEAD", 0)
+PREFETCH_INTERVAL = get_config("PREFETCH_INTERVAL", 60)
+PREFETCH_SHARE = get_config("PREFETCH_SHARE", 0.3, float)
+PREFETCH_MAX_PER_ROUND = get_config("PREFETCH_MAX_PER_ROUND", 10)
+PREFETCH_RESERVE = get_config("PREFETCH_RESERVE", 2)
+
+# Отложенная запись состояния: не чаще раза в интервал или после N изменений
+CACHE_FLUSH_INTERVAL = get_config("CACHE_FLUSH_INTERVAL", 10.0, float)
+CACHE_FLUSH_MAX_CHANGES = get_config("CACHE_FLUSH_MAX_CHANGES", 1000)
+
+# Пул для CPU-задач (отрисовка PIL): thread или process
+CPU_EXECUTOR = get_config("CPU_EXECUTOR", "thread", str).lower()
+CPU_WORKERS = get_config("CPU_WORKERS", min(4, os.cpu_count() or 1))
+CPU_QUEUE_MAX = get_config("CPU_QUEUE_MAX", 16)
+CPU_TASK_TIMEOUT = get_config("CPU_TASK_TIMEOUT", 10.0, float)
+
+# Формат резервного аватара: png или jpeg (кодируется в ~3 раза быстрее)
+PIL_FORMAT = get_config("PIL_FORMAT", "png", str).lower()
+# Сжатие PNG резервного аватара: 1 — быстро, 9 — компактно
+PIL_PNG_COMPRESS_LEVEL = get_config("PIL_PNG_COMPRESS_LEVEL", 1)
+
+# Пост-обработка аватаров перед кэшем и отправкой: формат (jpeg, webp или off),
+# максимальная сторона в пикселях и качество сжатия
+AVATAR_FORMAT = get_config("AVATAR_FORMAT", "jpeg", str).lower()
+AVATAR_MAX_DIM = get_config("AVATAR_MAX_DIM", 768)
+AVATAR_QUALITY = get_config("AVATAR_QUALITY", 85)
+
+# Интервал записи метрик в лог (0 — выключено)
+METRICS_LOG_INTERVAL = get_config("METRICS_LOG_INTERVAL", 300)
+
+# Исходящие запросы к Telegram: общий лимит (сообщений в секунду) и минимальный
+# интервал между сообщениями в личный чат и в группу/канал (20 в минуту)
+TG_GLOBAL_RATE = get_config("TG_GLOBAL_RATE", 30.0, float)
+TG_PRIVATE_INTERVAL = get_config("TG_PRIVATE_INTERVAL", 1.0, float)
+TG_GROUP_INTERVAL = get_config("TG_GROUP_INTERVAL", 3.0, float)
+TG_MAX_RETRIES = get_config("TG_MAX_RETRIES", 3)
+
+# ─────────── Ограниченный кэш ───────────
+class TTLCache:
+    """
+    LRU-кэш с TTL, лимитом по числу записей и по объёму в байтах.
+    Истёкшие записи удаляются активно: по куче, упорядоченной по времени
+    истечения, а не только при чтении.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        ttl: float,
+        max_entries: int = 0,
+        max_bytes: int = 0,
+        sizeof: Optional[Callable[[object], int]] = None,
+        grace: float = 0
+    ):
+        self.name = name
+        self.ttl = ttl
+        # Истёкшая запись хранится ещё grace секунд и доступна через get_stale
+        self.grace = grace
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        # key → (expires_at, value, size); порядок — от давно использованных к свежим
+        self._data: "OrderedDict[object, Tuple[float, object, int]]" = OrderedDict()
+        self._heap: list = []
+        self._seq = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+        self.stale = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key) -> bool:
+        entry = self._data.get(key)
+        return entry is not None and entry[0] > time.time()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        now = time.time()
+        if entry[0] <= now:
+            if entry[0] + self.grace <= now:
+                self._remove(key)
+                self.expired += 1
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def get_stale(self, key) -> Optional[Tuple[object, bool]]:
+        """
+        Как get, но в пределах grace отдаёт и истёкшее значение: (value, устарело ли).
+        Отдано ли устаревшее значение, решает вызывающий — он и считает stale.
+        """
+        entry = self._data.get(key)
+        now = time.time()
+        if entry is None or entry[0] + self.grace <= now:
+            if entry is not None:
+                self._remove(key)
+                self.expired += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        if entry[0] <= now:
+            return entry[1], True
+        self.hits += 1
+        return entry[1], False
+
+    def set(self, key, value, ttl: Optional[float] = None, expires_at: Optional[float] = None):
+        """Кладёт значение; expires_at — абсолютное время (time.time()) истечения."""
+        if expires_at is None:
+            expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        size = self.sizeof(value) if self.sizeof else 0
+
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = (expires_at, value, size)
+        self.bytes += size
+
+        self._seq += 1
+        heapq.heappush(self._heap, (expires_at, self._seq, key))
+        if len(self._heap) > 2 * len(self._data) + 64:
+            self._rebuild_heap()
+
+        self._evict()
+
+    def peek(self, key):
+        """(value, expires_at) без учёта в LRU и счётчиках, или None."""
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry[1], entry[0]
+
+    def peek_stale(self, key):
+        """Как peek, но с учётом grace: значение или None."""
+        entry = self._data.get(key)
+        if entry is None or entry[0] + self.grace <= time.time():
+            return None
+        return entry[1]
+
+    def pop(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        self._remove(key)
+        return entry[1]
+
+    def items(self):
+        """Неистёкшие записи: (key, value, expires_at)."""
+        now = time.time()
+        return [(k, v, exp) for k, (exp, v, _) in self._data.items() if exp > now]
+
+    def sweep(self) -> int:
+        """Удаляет истёкшие записи, возвращает их количество."""
+        now = time.time()
+        removed = 0
+        while self._heap and self._heap[0][0] + self.grace <= now:
+            expires_at, _, key = heapq.heappop(self._heap)
+            entry = self._data.get(key)
+            # Запись могла быть перезаписана с другим сроком — тогда элемент кучи устарел
+            if entry is not None and entry[0] == expires_at:
+                self._remove(key)
+                removed += 1
+        self.expired += removed
+        return removed
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._data),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "stale": self.stale,
+        }
+
+    def _remove(self, key):
+        _, _, size = self._data.pop(key)
+        self.bytes -= size
+
+    def _evict(self):
+        while self._data and (
+            (self.max_entries and len(self._data) > self.max_entries)
+            or (self.max_bytes and self.bytes > self.max_bytes)
+        ):
+            key = next(iter(self._data))
+            self._remove(key)
+            self.evictions += 1
+
+    def _rebuild_heap(self):
+        self._heap = [(exp, i, key) for i, (key, (exp, _, _)) in enumerate(self._data.items())]
+        heapq.heapify(self._heap)
+        self._seq = len(self._heap)
+
+
+async def sweep_caches_periodically(*caches: TTLCache):
+    """Фоновая очистка истёкших записей, чтобы память не росла."""
+    while True:
+        await asyncio.sleep(CACHE_SWEEP_INTERVAL)
+        for c in caches:
+            removed = c.sweep()
+            if removed:
+                log.info(f"Кэш {c.name}: удалено {removed} истёкших записей")
+
+
+class SingleFlight:
+    """Объединяет одновременные вызовы с одинаковым ключом в одно выполнение."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: Dict[object, asyncio.Future] = {}
+        self.started = 0
+        self.shared = 0
+
+    async def do(self, key, fn: Callable[[], Awaitable]):
+        task = self._inflight.get(key)
+        if task is not None:
+            self.shared += 1
+        else:
+            self.started += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        # shield: отмена одного ожидающего не отменяет генерацию для остальных
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task: asyncio.Future):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._inflight), "started": self.started, "shared": self.shared}
+
 
 # ─────────── Кэш с персистентностью ───────────
-cache: Dict[str, Tuple[datetime, int, str]] = {}
-img_cache: Dict[int, Tuple[datetime, bytes]] = {}
+# uid → Profile
+cache = TTLCache("stats", TTL_SECONDS, max_entries=STATS_CACHE_MAX_ENTRIES, grace=STALE_GRACE)
+# (uid, вес, хуй, IQ, рост) → (время генерации, PNG или None, file_id в Telegram)
+img_cache = TTLCache(
+    "images", TTL_SECONDS,
+    max_bytes=IMG_CACHE_MAX_BYTES,
+    # После рестарта у записи может быть только file_id без байтов
+    sizeof=lambda entry: len(entry[1]) if entry[1] is not None else 0,
+    grace=STALE_GRACE
+)
+# uid → Profile следующего окна, подготовленный предзагрузкой (STATS_MODE=random)
+upcoming_profiles = TTLCache("upcoming", 2 * TTL_SECONDS, max_entries=STATS_CACHE_MAX_ENTRIES)
+# uid → имя пользователя, недавно запрашивавшего аватар (кандидаты для предзагрузки)
+active_users = TTLCache("active_users", TTL_SECONDS, max_entries=STATS_CACHE_MAX_ENTRIES)
 
 
-def load_cache_from_disk():
-    """Загружает кэш из файла при старте."""
-    global cache
-    try:
-        if CACHE_FILE.exists():
+# ─────────── Хранилище состояния ───────────
+class StateStore:
+    """
+    Хранилище состояния: пространство имён → ключ → (значение, срок истечения).
+    Запись инкрементальная, истёкшие записи при чтении пропускаются.
+    """
+
+    def get(self, ns: str, key: str):
+        raise NotImplementedError
+
+    def iter(self, ns: str) -> Iterator[Tuple[str, object, float]]:
+        """Лениво отдаёт неистёкшие записи (key, value, expires_at)."""
+        raise NotImplementedError
+
+    def put_many(self, records: List[Tuple[str, str, object, float]]) -> None:
+        """Записывает (ns, key, value, expires_at) одной транзакцией."""
+        raise NotImplementedError
+
+    def compact(self) -> int:
+        """Удаляет истёкшие записи, возвращает их количество."""
+        return 0
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryStore(StateStore):
+    """Хранилище без персистентности (STATE_BACKEND=memory)."""
+
+    def __init__(self):
+        self._data: Dict[Tuple[str, str], Tuple[object, float]] = {}
+
+    def get(self, ns: str, key: str):
+        entry = self._data.get((ns, key))
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0]
+
+    def iter(self, ns: str):
+        now = time.time()
+        for (entry_ns, key), (value, expires_at) in list(self._data.items()):
+            if entry_ns == ns and expires_at > now:
+                yield key, value, expires_at
+
+    def put_many(self, records):
+        for ns, key, value, expires_at in records:
+            self._data[(ns, key)] = (value, expires_at)
+
+    def compact(self) -> int:
+        now = time.time()
+        expired = [k for k, (_, exp) in self._data.items() if exp <= now]
+        for k in expired:
+            del self._data[k]
+        return len(expired)
+
+
+class SqliteStore(StateStore):
+    """SQLite в режиме WAL: запись одной записи — один UPSERT, без перезаписи файла."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        # Запись идёт из рабочих потоков, поэтому соединение защищено блокировкой
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            " ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL, PRIMARY KEY (ns, key)) WITHOUT ROWID"
+        )
+        self._db.commit()
+
+    def get(self, ns: str, key: str):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM state WHERE ns = ? AND key = ? AND expires_at > ?",
+                (ns, key, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def iter(self, ns: str):
+        with self._lock:
+            cursor = self._db.execute(
+                "SELECT key, value, expires_at FROM state WHERE ns = ? AND expires_at > ?",
+                (ns, time.time())
+            )
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(1000)
+            if not rows:
+                return
+            for key, value, expires_at in rows:
+                yield key, json.loads(value), expires_at
+
+    def put_many(self, records):
+        rows = [
+            (ns, key, json.dumps(value, ensure_ascii=False), expires_at)
+            for ns, key, value, expires_at in records
+        ]
+        with self._lock:
+            with self._db:
+                self._db.executemany(
+                    "INSERT INTO state (ns, key, value, expires_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (ns, key) DO UPDATE SET "
+                    "value = excluded.value, expires_at = excluded.expires_at",
+                    rows
+                )
+
+    def compact(self) -> int:
+        with self._lock:
+            with self._db:
+                cur = self._db.execute("DELETE FROM state WHERE expires_at <= ?", (time.time(),))
+            self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return cur.rowcount
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+def open_state_store() -> StateStore:
+    if STATE_BACKEND == "memory":
+        log.info("Хранилище состояния: память (без персистентности)")
+        return MemoryStore()
+    if STATE_BACKEND != "sqlite":
+        log.warning(f"Неизвестный STATE_BACKEND={STATE_BACKEND!r}, используется sqlite")
+    log.info(f"Хранилище состояния: SQLite WAL ({STATE_DB_FILE})")
+    return SqliteStore(STATE_DB_FILE)
+
+
+state_store = open_state_store()
+
+
+def migrate_legacy_files(store: StateStore) -> None:
+    """Однократно импортирует cache.json и api_usage.json из старых версий."""
+    if CACHE_FILE.exists():
+        try:
             with open(CACHE_FILE, 'r') as f:
                 data = json.load(f)
-                for key, (timestamp_str, val, emo) in data.items():
-                    timestamp = datetime.fromisoformat(timestamp_str)
-                    if datetime.now() - timestamp <= TTL:
-                        cache[key] = (timestamp, val, emo)
-            log.info(f"Загружено {len(cache)} записей из кэша")
+            records = profiles_from_legacy(
+                (key, val, datetime.fromisoformat(ts).timestamp() + TTL_SECONDS)
+                for key, (ts, val, emo) in data.items()
+            )
+            store.put_many(records)
+            CACHE_FILE.rename(CACHE_FILE.with_name(CACHE_FILE.name + ".migrated"))
+            log.info(f"Импортировано {len(records)} записей из {CACHE_FILE}")
+        except Exception as e:
+            log.warning(f"Не удалось импортировать {CACHE_FILE}: {e}")
+
+    if API_USAGE_FILE.exists():
+        try:
+            with open(API_USAGE_FILE, 'r') as f:
+                usage = json.load(f)
+            store.put_many([("usage", "search", usage, time.time() + 2 * 86400)])
+            API_USAGE_FILE.rename(API_USAGE_FILE.with_name(API_USAGE_FILE.name + ".migrated"))
+            log.info(f"Импортирован счётчик API из {API_USAGE_FILE}")
+        except Exception as e:
+            log.warning(f"Не удалось импортировать {API_USAGE_FILE}: {e}")
+
+
+def profiles_from_legacy(entries) -> list:
+    """
+    Собирает записи профилей из cache.json старого формата «label_uid» → значение.
+    Профиль создаётся, только если известны все четыре значения.
+    """
+    now = time.time()
+    by_uid: Dict[int, dict] = {}
+    for key, val, expires_at in entries:
+        label, _, uid = key.rpartition("_")
+        if label in RANGES and expires_at > now:
+            fields = by_uid.setdefault(int(uid), {"expires_at": expires_at})
+            fields[label] = val
+            fields["expires_at"] = min(fields["expires_at"], expires_at)
+
+    return [
+        ("profile", str(uid), [f[label] for label in RANGES], f["expires_at"])
+        for uid, f in by_uid.items()
+        if all(label in f for label in RANGES)
+    ]
+
+
+def avatar_key_str(key: tuple) -> str:
+    return ":".join(map(str, key))
+
+
+def load_cache_from_disk():
+    """Загружает неистёкшие значения и file_id аватаров при старте."""
+    try:
+        migrate_legacy_files(state_store)
+        quotas.load(state_store)
+
+        for key, stats, expires_at in state_store.iter("profile"):
+            cache.set(int(key), Profile(expires_at, *stats), expires_at=expires_at)
+
+        # Байты аватаров не сохраняются — только file_id, по которому Telegram отдаст фото
+        images = 0
+        for key, file_id, expires_at in state_store.iter("file_id"):
+            ts = datetime.fromtimestamp(expires_at - TTL_SECONDS)
+            img_cache.set(tuple(map(int, key.split(":"))), (ts, None, file_id), expires_at=expires_at)
+            images += 1
+
+        log.info(f"Загружено {len(cache)} профилей из кэша и {images} file_id аватаров")
     except Exception as e:
         log.warning(f"Не удалось загрузить кэш: {e}")
 
 
-async def save_cache_to_disk():
-    """Сохраняет кэш в файл."""
-    async with cache_lock:
+def snapshot_state(keys: set) -> list:
+    """Собирает изменённые записи для хранилища (выполняется в event loop)."""
+    records = []
+    for ns, key in keys:
+        if ns == "profile":
+            entry = cache.peek(key)
+            if entry is not None:
+                profile, expires_at = entry
+                records.append((ns, str(key), list(profile.stats), expires_at))
+        elif ns == "usage":
+            usage = quotas.record(key)
+            if usage is not None:
+                # Счётчик хранится двое суток — этого хватает до сброса в полночь UTC
+                records.append((ns, key, usage, time.time() + 2 * 86400))
+        elif ns == "file_id":
+            entry = img_cache.peek(key)
+            if entry is not None and entry[0][2]:
+                (_, _, file_id), expires_at = entry
+                records.append((ns, avatar_key_str(key), file_id, expires_at))
+    return records
+
+
+class WriteBehind:
+    """
+    Отложенная запись на диск: изменения только помечают ключи «грязными»,
+    а сброс выполняется не чаще раза в interval секунд (или сразу после
+    max_changes изменений) в отдельном потоке, не блокируя event loop.
+    В хранилище уходят только изменённые записи.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        snapshot: Callable[[set], object],
+        write: Callable[[object], None],
+        interval: float,
+        max_changes: int
+    ):
+        self.name = name
+        self.snapshot = snapshot
+        self.write = write
+        self.interval = interval
+        self.max_changes = max_changes
+        self._pending: set = set()
+        self._dirty = asyncio.Event()
+        self._urgent = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self.flushes = 0
+
+    def mark_dirty(self, key):
+        self._pending.add(key)
+        self._dirty.set()
+        if len(self._pending) >= self.max_changes:
+            self._urgent.set()
+
+    async def run(self):
+        """Фоновый цикл сброса."""
+        while True:
+            await self._dirty.wait()
+            try:
+                await asyncio.wait_for(self._urgent.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self):
+        """Сбрасывает накопленные изменения, если они есть."""
+        async with self._lock:
+            if not self._pending:
+                return
+            # Снимок берётся в event loop, сериализация и fsync — в потоке
+            keys, self._pending = self._pending, set()
+            data = self.snapshot(keys)
+            self._dirty.clear()
+            self._urgent.clear()
+            try:
+                await asyncio.to_thread(self.write, data)
+                self.flushes += 1
+                log.debug(f"{self.name}: записано ({len(keys)} изменений)")
+            except asyncio.CancelledError:
+                self._pending |= keys
+                self._dirty.set()
+                raise
+            except Exception as e:
+                log.warning(f"Не удалось сохранить {self.name}: {e}")
+                self._pending |= keys
+                self._dirty.set()
+
+    def stats(self) -> dict:
+        return {"pending": len(self._pending), "flushes": self.flushes}
+
+
+state_persister = WriteBehind(
+    "state",
+    snapshot=snapshot_state,
+    write=state_store.put_many,
+    interval=CACHE_FLUSH_INTERVAL,
+    max_changes=CACHE_FLUSH_MAX_CHANGES
+)
+
+
+async def compact_state_periodically():
+    """Удаляет из хранилища истёкшие записи."""
+    while True:
+        await asyncio.sleep(STATE_COMPACT_INTERVAL)
+        try:
+            removed = await asyncio.to_thread(state_store.compact)
+            if removed:
+                log.info(f"Хранилище состояния: удалено {removed} истёкших записей")
+        except Exception as e:
+            log.warning(f"Ошибка компактизации хранилища: {e}")
+
+
+# ─────────── Квоты внешних API ───────────
+class QuotaExceeded(RuntimeError):
+    pass
+
+
+class Quota:
+    """
+    Квота одного внешнего API: дневной счётчик со сбросом в полночь UTC
+    и token bucket на минуту. Всё в памяти, проверка не блокирует.
+    """
+
+    def __init__(self, name: str, per_day: int = 0, per_minute: int = 0):
+        self.name = name
+        self.per_day = per_day
+        self.per_minute = per_minute
+        self.date = datetime.utcnow().strftime("%Y-%m-%d")
+        self.count = 0
+        self.denied = 0
+        self._tokens = float(per_minute)
+        self._updated = time.monotonic()
+
+    def _roll(self):
+        today = datetime.utcnow().strftime("%Y-%m-%d")
+        if today != self.date:
+            log.info(f"Новый день. Сбрасываем счётчик {self.name}.")
+            self.date = today
+            self.count = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.per_minute:
+            self._tokens = min(
+                float(self.per_minute), self._tokens + (now - self._updated) * self.per_minute / 60
+            )
+        self._updated = now
+
+    def day_exhausted(self, reserve: int = 0) -> bool:
+        self._roll()
+        return bool(self.per_day) and self.count + reserve >= self.per_day
+
+    def rate_exhausted(self, reserve: int = 0) -> bool:
+        self._refill()
+        return bool(self.per_minute) and self._tokens < 1 + reserve
+
+    def take_token(self):
+        if self.per_minute:
+            self._tokens -= 1
+
+    def stats(self) -> dict:
+        self._refill()
+        return {
+            "today": self.count,
+            "per_day": self.per_day,
+            "tokens": round(self._tokens, 1),
+            "per_minute": self.per_minute,
+            "denied": self.denied,
+        }
+
+
+class QuotaManager:
+    """
+    Бюджеты внешних API. Минутные лимиты считаются в процессе; дневной
+    счётчик ведёт shared_state (в памяти с отложенной записью в state_store
+    или в Redis, общий для всех воркеров).
+    """
+
+    def __init__(self, *quotas: Quota):
+        self.quotas = {q.name: q for q in quotas}
+
+    def would_exceed(self, name: str, reserve: int = 0) -> bool:
+        """
+        Неблокирующая проверка: будет ли следующий вызов отклонён.
+        reserve — сколько вызовов оставить про запас (для фоновых задач).
+        """
+        quota = self.quotas[name]
+        return quota.rate_exhausted(reserve) or quota.day_exhausted(reserve)
+
+    async def acquire(self, name: str) -> Tuple[bool, int]:
+        """Списывает один вызов; возвращает (разрешён ли, счётчик за сутки)."""
+        quota = self.quotas[name]
+        if quota.rate_exhausted():
+            quota.denied += 1
+            return False, quota.count
+        if quota.per_day:
+            allowed, count = await shared_state.incr_quota(name, quota.per_day)
+            quota.count = count
+            if not allowed:
+                quota.denied += 1
+                return False, count
+        else:
+            quota.count += 1
+        quota.take_token()
+        return True, quota.count
+
+    def incr_local(self, name: str, limit: int) -> Tuple[bool, int]:
+        """Дневной счётчик в памяти процесса (для LocalState)."""
+        quota = self.quotas[name]
+        if quota.day_exhausted() or quota.count >= limit:
+            return False, quota.count
+        quota.count += 1
+        state_persister.mark_dirty(("usage", name))
+        return True, quota.count
+
+    def record(self, name: str) -> Optional[dict]:
+        quota = self.quotas.get(name)
+        if quota is None:
+            return None
+        return {"date": quota.date, "count": quota.count}
+
+    def load(self, store: StateStore):
+        today = datetime.utcnow().strftime("%Y-%m-%d")
+        for name, usage, _ in store.iter("usage"):
+            quota = self.quotas.get(name)
+            if quota is not None and usage.get("date") == today:
+                quota.count = usage.get("count", 0)
+
+    def stats(self) -> dict:
+        return {name: q.stats() for name, q in self.quotas.items()}
+
+
+quotas = QuotaManager(
+    Quota("search", per_day=SEARCH_API_DAILY_LIMIT),
+    Quota("gemini_text", per_day=GEMINI_TEXT_RPD, per_minute=GEMINI_TEXT_RPM),
+    Quota("gemini_image", per_day=GEMINI_IMAGE_RPD, per_minute=GEMINI_IMAGE_RPM),
+)
+
+
+# ─────────── Общее состояние воркеров ───────────
+class SharedState:
+    """
+    Состояние, которое должно совпадать у всех процессов-воркеров бота:
+    профили, дневные квоты API, file_id аватаров и блокировки генерации.
+    """
+
+    name = "base"
+
+    async def get_or_create_profile(self, uid: int, factory: Callable[[], "Profile"]) -> "Profile":
+        raise NotImplementedError
+
+    async def incr_quota(self, name: str, limit: int) -> Tuple[bool, int]:
+        """Атомарно увеличивает дневной счётчик, если лимит не исчерпан."""
+        raise NotImplementedError
+
+    async def acquire_flight(self, key: str, ttl: float) -> bool:
+        """Захватывает право сгенерировать аватар для ключа."""
+        return True
+
+    async def release_flight(self, key: str) -> None:
+        pass
+
+    async def get_file_id(self, key: str) -> Optional[str]:
+        return None
+
+    async def set_file_id(self, key: str, file_id: str, expires_at: float) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": self.name}
+
+    async def close(self) -> None:
+        pass
+
+
+class LocalState(SharedState):
+    """Один процесс: профили и счётчики в памяти, персистентность — через state_store."""
+
+    name = "local"
+
+    async def get_or_create_profile(self, uid, factory):
+        profile = factory()
+        # Запись на диск отложена и объединяется с соседними изменениями
+        state_persister.mark_dirty(("profile", uid))
+        return profile
+
+    async def incr_quota(self, name, limit):
+        # Счётчик в памяти; на диск уходит вместе с остальным состоянием
+        return quotas.incr_local(name, limit)
+
+
+class RedisError(RuntimeError):
+    pass
+
+
+class RedisState(SharedState):
+    """
+    Несколько процессов: состояние в Redis (или любом сервере с протоколом RESP).
+    Клиент минимальный — одно соединение, команды выполняются последовательно.
+    """
+
+    name = "redis"
+
+    # Снимает блокировку, только если она всё ещё принадлежит этому воркеру
+    RELEASE_SCRIPT = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('del', KEYS[1]) else return 0 end"
+    )
+
+    def __init__(self, url: str):
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+        self.commands = 0
+        self.errors = 0
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            await self._roundtrip("AUTH", self.password)
+        if self.db:
+            await self._roundtrip("SELECT", self.db)
+
+    async def _roundtrip(self, *args):
+        out = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        self._writer.write(b"".join(out))
+        await self._writer.drain()
+        return await self._read_reply()
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("Redis закрыл соединение")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode()
+        if kind == b"-":
+            raise RedisError(body.decode())
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            size = int(body)
+            if size < 0:
+                return None
+            data = await self._reader.readexactly(size + 2)
+            return data[:-2].decode()
+        if kind == b"*":
+            size = int(body)
+            return None if size < 0 else [await self._read_reply() for _ in range(size)]
+        raise RedisError(f"Неизвестный ответ: {line!r}")
+
+    async def command(self, *args):
+        async with self._lock:
+            self.commands += 1
+            try:
+                if self._writer is None or self._writer.is_closing():
+                    await self._connect()
+                return await self._roundtrip(*args)
+            except RedisError:
+                raise
+            except (ConnectionError, OSError, asyncio.IncompleteReadError):
+                self.errors += 1
+                self._drop()
+                raise
+            except BaseException:
+                # Прерванная команда (отмена, таймаут) оставила бы свой ответ
+                # в соединении, и его прочитала бы следующая команда
+                self._drop()
+                raise
+
+    def _drop(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._writer = None
+
+    async def get_or_create_profile(self, uid, factory):
+        key = f"psi:profile:{uid}"
+        profile = factory()
+        value = ",".join(map(str, (profile.expires_at, *profile.stats)))
+        # Кто первым записал профиль — того значения и видят все воркеры
+        created = await self.command(
+            "SET", key, value, "NX", "PXAT", int(profile.expires_at * 1000)
+        )
+        if created:
+            return profile
+        stored = await self.command("GET", key)
+        if stored is None:
+            return profile
+        expires_at, *stats = stored.split(",")
+        return Profile(float(expires_at), *map(int, stats))
+
+    async def incr_quota(self, name, limit):
+        key = f"psi:quota:{name}:{datetime.utcnow().strftime('%Y-%m-%d')}"
+        count = await self.command("INCR", key)
+        if count == 1:
+            await self.command("EXPIRE", key, 2 * 86400)
+        if count > limit:
+            return False, limit
+        return True, count
+
+    async def acquire_flight(self, key, ttl):
+        return bool(await self.command(
+            "SET", f"psi:flight:{key}", self.worker_id, "NX", "PX", int(ttl * 1000)
+        ))
+
+    async def release_flight(self, key):
+        await self.command("EVAL", self.RELEASE_SCRIPT, 1, f"psi:flight:{key}", self.worker_id)
+
+    async def get_file_id(self, key):
+        return await self.command("GET", f"psi:file_id:{key}")
+
+    async def set_file_id(self, key, file_id, expires_at):
+        await self.command("SET", f"psi:file_id:{key}", file_id, "PXAT", int(expires_at * 1000))
+
+    def stats(self) -> dict:
+        return {"backend": self.name, "commands": self.commands, "errors": self.errors}
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+def open_shared_state() -> SharedState:
+    if STATE_REDIS_URL:
+        log.info("Общее состояние воркеров: Redis")
+        return RedisState(STATE_REDIS_URL)
+    return LocalState()
+
+
+shared_state = open_shared_state()
+
+
+# ─────────── HTTP-сессия ───────────
+http_session: Optional[aiohttp.ClientSession] = None
+
+
+def http_timeout(total: float) -> aiohttp.ClientTimeout:
+    """Таймаут запроса с общим лимитом на установку соединения."""
+    return aiohttp.ClientTimeout(total=total, connect=HTTP_CONNECT_TIMEOUT)
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """
+    Возвращает общую для процесса сессию aiohttp.
+    Keep-alive, лимиты на хост и DNS-кэш позволяют не делать TCP+TLS
+    рукопожатие на каждый вызов Gemini/Google.
+    """
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            use_dns_cache=True,
+        )
+        http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=http_timeout(HTTP_TOTAL_TIMEOUT),
+        )
+        log.info(
+            f"HTTP-пул создан (limit={HTTP_POOL_LIMIT}, "
+            f"per_host={HTTP_POOL_LIMIT_PER_HOST}, keepalive={HTTP_KEEPALIVE_TIMEOUT}s)"
+        )
+    return http_session
+
+
+async def close_http_session():
+    """Закрывает общую сессию при остановке бота."""
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+
+def http_pool_stats() -> dict:
+    """Статистика пула соединений: открытые, простаивающие и ожидающие."""
+    if http_session is None or http_session.closed:
+        return {"open": 0, "idle": 0, "in_use": 0, "waiting": 0}
+
+    connector = http_session.connector
+    idle_by_host = getattr(connector, "_conns", {})
+    acquired = getattr(connector, "_acquired", set())
+    waiters = getattr(connector, "_waiters", {})
+
+    idle = sum(len(conns) for conns in idle_by_host.values())
+    waiting = sum(len(w) for w in waiters.values())
+    return {
+        "open": idle + len(acquired),
+        "idle": idle,
+        "in_use": len(acquired),
+        "waiting": waiting,
+        "hosts": {
+            f"{key.host}:{key.port}": len(conns)
+            for key, conns in idle_by_host.items()
+        },
+    }
+
+
+# ─────────── Пул для CPU-задач ───────────
+class CpuPoolBusy(RuntimeError):
+    pass
+
+
+class CpuPool:
+    """
+    Выносит CPU-тяжёлую работу (отрисовка PIL, разбор HTML) из event loop
+    в пул потоков или процессов. Очередь ограничена: задача ждёт свободного
+    места не дольше своего таймаута, а затем отклоняется.
+    """
+
+    def __init__(self, kind: str, workers: int, queue_max: int, timeout: float):
+        self.kind = kind
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(workers + queue_max)
+        self._executor = None
+        self.running = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.rejected = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="cpu"
+                )
+        return self._executor
+
+    async def run(self, fn: Callable, *args, timeout: Optional[float] = None):
+        timeout = timeout or self.timeout
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise CpuPoolBusy(f"Пул CPU-задач переполнен ({fn.__name__})")
+
+        self.running += 1
         try:
-            data = {
-                key: (timestamp.isoformat(), val, emo)
-                for key, (timestamp, val, emo) in cache.items()
-            }
-            with open(CACHE_FILE, 'w') as f:
-                json.dump(data, f)
+            future = asyncio.get_running_loop().run_in_executor(self._get_executor(), fn, *args)
+            remaining = max(0.1, timeout - (time.monotonic() - started))
+            # В пуле потоков задачу нельзя прервать — по таймауту перестаём её ждать
+            result = await asyncio.wait_for(future, remaining)
+            self.completed += 1
+            return result
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            self.running -= 1
+            self._slots.release()
+
+    def stats(self) -> dict:
+        return {
+            "kind": self.kind,
+            "running": self.running,
+            "completed": self.completed,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+cpu_pool = CpuPool(CPU_EXECUTOR, CPU_WORKERS, CPU_QUEUE_MAX, CPU_TASK_TIMEOUT)
+
+
+# ─────────── Очередь исходящих сообщений ───────────
+class OutboundJob:
+    __slots__ = ("priority", "seq", "chat_id", "key", "make_request", "bot", "method", "future", "enqueued")
+
+    def __init__(self, priority, seq, chat_id, key, make_request, bot, method):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.key = key
+        self.make_request = make_request
+        self.bot = bot
+        self.method = method
+        self.future = asyncio.get_running_loop().create_future()
+        # Если ожидавший отменён, исключение всё равно считается полученным
+        self.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.enqueued = time.monotonic()
+
+
+class TelegramOutbox(BaseRequestMiddleware):
+    """
+    Центральная очередь исходящих сообщений (middleware сессии aiogram).
+
+    Отправки и правки сообщений уходят не чаще, чем позволяет Telegram: общий
+    token bucket на бота и минимальный интервал на чат; сообщения одного чата
+    отправляются строго по порядку. Ответы пользователям идут раньше загрузок
+    в канал-хранилище. Несколько правок одного сообщения, ждущих в очереди,
+    сливаются в одну (уходит последняя). На 429 запрос повторяется после
+    retry_after. Прочие методы (answerCallbackQuery, getUpdates…) идут напрямую.
+    """
+
+    THROTTLED = ("send", "edit", "copy", "forward")
+
+    def __init__(self, global_rate: float, private_interval: float, group_interval: float, max_retries: int):
+        self.global_rate = global_rate
+        self.private_interval = private_interval
+        self.group_interval = group_interval
+        self.max_retries = max_retries
+        self._queue: List[OutboundJob] = []
+        self._edits: Dict[tuple, OutboundJob] = {}
+        self._chat_ready: Dict[object, float] = {}
+        self._busy: set = set()
+        self._running: set = set()
+        self._tokens = global_rate
+        self._updated = time.monotonic()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._seq = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.delay_total = 0.0
+        self.delay_max = 0.0
+
+    async def __call__(self, make_request, bot, method):
+        api = method.__api_method__
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not api.startswith(self.THROTTLED) or api == "sendChatAction":
+            return await make_request(bot, method)
+
+        key = None
+        if api.startswith("edit"):
+            key = (api, chat_id, getattr(method, "message_id", None))
+            queued = self._edits.get(key)
+            if queued is not None:
+                # Правка ещё не ушла — отправится только самая свежая версия
+                queued.method = method
+                queued.make_request = make_request
+                self.coalesced += 1
+                return await asyncio.shield(queued.future)
+
+        priority = 1 if STORAGE_CHAT_ID and str(chat_id) == str(STORAGE_CHAT_ID) else 0
+        self._seq += 1
+        job = OutboundJob(priority, self._seq, chat_id, key, make_request, bot, method)
+        self._queue.append(job)
+        self._queue.sort(key=lambda j: (j.priority, j.seq))
+        if key is not None:
+            self._edits[key] = job
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+        return await asyncio.shield(job.future)
+
+    def _interval(self, chat_id) -> float:
+        if isinstance(chat_id, int) and chat_id > 0:
+            return self.private_interval
+        return self.group_interval
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            wait = self._dispatch()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch(self) -> Optional[float]:
+        """Запускает всё, что можно отправить сейчас; возвращает паузу до следующей попытки."""
+        now = time.monotonic()
+        self._tokens = min(self.global_rate, self._tokens + (now - self._updated) * self.global_rate)
+        self._updated = now
+
+        wait = None
+        blocked = set()
+        for job in list(self._queue):
+            chat_id = job.chat_id
+            if chat_id in blocked or chat_id in self._busy:
+                blocked.add(chat_id)
+                continue
+            ready_at = self._chat_ready.get(chat_id, 0.0)
+            if ready_at > now:
+                blocked.add(chat_id)
+                wait = min(wait, ready_at - now) if wait is not None else ready_at - now
+                continue
+            if self._tokens < 1:
+                pause = (1 - self._tokens) / self.global_rate
+                wait = min(wait, pause) if wait is not None else pause
+                break
+
+            self._tokens -= 1
+            self._queue.remove(job)
+            if job.key is not None:
+                self._edits.pop(job.key, None)
+            self._busy.add(chat_id)
+            self._chat_ready[chat_id] = now + self._interval(chat_id)
+            delay = now - job.enqueued
+            self.delay_total += delay
+            self.delay_max = max(self.delay_max, delay)
+            task = asyncio.create_task(self._execute(job))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+        if len(self._chat_ready) > 10_000:
+            self._chat_ready = {c: t for c, t in self._chat_ready.items() if t > now}
+        return wait
+
+    async def _execute(self, job: OutboundJob):
+        try:
+            attempt = 0
+            while True:
+                try:
+                    result = await job.make_request(job.bot, job.method)
+                    break
+                except TelegramRetryAfter as e:
+                    attempt += 1
+                    if attempt > self.max_retries:
+                        raise
+                    self.retried += 1
+                    log.warning(f"Telegram: flood control в чате {job.chat_id}, повтор через {e.retry_after} с")
+                    self._chat_ready[job.chat_id] = time.monotonic() + e.retry_after
+                    await asyncio.sleep(e.retry_after)
+            self.sent += 1
+            if not job.future.done():
+                job.future.set_result(result)
         except Exception as e:
-            log.warning(f"Не удалось сохранить кэш: {e}")
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            self._busy.discard(job.chat_id)
+            self._wakeup.set()
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self._queue),
+            "in_flight": len(self._busy),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "retried": self.retried,
+            "delay_avg_ms": round(self.delay_total / self.sent * 1000, 1) if self.sent else 0.0,
+            "delay_max_ms": round(self.delay_max * 1000, 1),
+        }
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        for job in self._queue:
+            if not job.future.done():
+                job.future.set_exception(RuntimeError("бот останавливается"))
+        self._queue.clear()
+        self._edits.clear()
+
+
+outbox = TelegramOutbox(TG_GLOBAL_RATE, TG_PRIVATE_INTERVAL, TG_GROUP_INTERVAL, TG_MAX_RETRIES)
+bot.session.middleware(outbox)
 
 
 # ─────────── Генераторы значений ───────────
@@ -189,44 +1523,194 @@ def _emo(val: int, tbl: dict) -> str:
     return ""
 
 
+# Диапазоны значений: метка → (минимум, максимум, таблица эмодзи)
+RANGES = {
+    "weight": (0, 250, "w"),
+    "cock": (0, 50, "c"),
+    "iq": (50, 200, "iq"),
+    "height": (140, 220, "h"),
+}
+
+
 def gen_w():
-    v = random.randint(0, 250)
-    return v, _emo(v, EMO["w"])
+    lo, hi, _ = RANGES["weight"]
+    v = random.randint(lo, hi)
+    return v, emo_for("weight", v)
 
 
 def gen_c():
-    v = random.randint(0, 50)
-    return v, _emo(v, EMO["c"])
+    lo, hi, _ = RANGES["cock"]
+    v = random.randint(lo, hi)
+    return v, emo_for("cock", v)
 
 
 def gen_iq():
-    v = random.randint(50, 200)
-    return v, _emo(v, EMO["iq"])
+    lo, hi, _ = RANGES["iq"]
+    v = random.randint(lo, hi)
+    return v, emo_for("iq", v)
 
 
 def gen_h():
-    v = random.randint(140, 220)
-    return v, _emo(v, EMO["h"])
+    lo, hi, _ = RANGES["height"]
+    v = random.randint(lo, hi)
+    return v, emo_for("height", v)
 
 
 gens = {"weight": gen_w, "cock": gen_c, "iq": gen_iq, "height": gen_h}
 
 
-async def cached_val(uid: int, label: str) -> Tuple[int, str]:
-    """Возвращает кэшированное или новое значение."""
-    async with cache_lock:
-        now = datetime.now()
-        key = f"{label}_{uid}"
+# Эмодзи, заранее разложенные по значениям: метка → (минимум, кортеж эмодзи)
+EMO_LOOKUP = {
+    label: (lo, tuple(_emo(v, EMO[tbl]) for v in range(lo, hi + 1)))
+    for label, (lo, hi, tbl) in RANGES.items()
+}
+
+
+def emo_for(label: str, val: int) -> str:
+    """Эмодзи для значения индексом в таблице, без разбора диапазонов."""
+    lo, table = EMO_LOOKUP[label]
+    i = val - lo
+    return table[i] if 0 <= i < len(table) else ""
+
+
+class Profile:
+    """Все четыре значения пользователя одной компактной записью."""
+
+    __slots__ = ("expires_at", "w", "c", "iq", "h")
+
+    def __init__(self, expires_at: float, w: int, c: int, iq: int, h: int):
+        self.expires_at = expires_at
+        self.w = w
+        self.c = c
+        self.iq = iq
+        self.h = h
+
+    def get(self, label: str) -> Tuple[int, str]:
+        """(значение, эмодзи) по метке weight/cock/iq/height."""
+        v = getattr(self, RANGES[label][2])
+        return v, emo_for(label, v)
+
+    @property
+    def stats(self) -> Tuple[int, int, int, int]:
+        return self.w, self.c, self.iq, self.h
+
+    @property
+    def wt(self) -> str:
+        return emo_for("weight", self.w)
+
+    @property
+    def ct(self) -> str:
+        return emo_for("cock", self.c)
+
+    @property
+    def iqt(self) -> str:
+        return emo_for("iq", self.iq)
+
+    @property
+    def ht(self) -> str:
+        return emo_for("height", self.h)
+
+
+def hashed_val(uid: int, label: str, bucket: int) -> int:
+    """
+    Детерминированное значение из HMAC(секрет, uid, метка, номер окна TTL).
+    В пределах окна значение стабильно без кэша, блокировки и записи на диск.
+    """
+    lo, hi, _ = RANGES[label]
+    digest = hmac.new(STATS_SECRET, f"{uid}:{label}:{bucket}".encode(), hashlib.sha256).digest()
+    return lo + int.from_bytes(digest[:8], "big") % (hi - lo + 1)
+
+
+def uid_phase(uid: int) -> int:
+    """Постоянный сдвиг окон пользователя в hash-режиме (0 при TTL_JITTER=0)."""
+    spread = int(TTL_SECONDS * TTL_JITTER)
+    if spread <= 0:
+        return 0
+    digest = hmac.new(STATS_SECRET, f"{uid}:phase".encode(), hashlib.sha256).digest()
+    return int.from_bytes(digest[:8], "big") % spread
+
+
+def current_bucket(uid: int) -> int:
+    return (int(time.time()) + uid_phase(uid)) // TTL_SECONDS
+
+
+def hashed_profile(uid: int, bucket: int) -> Profile:
+    return Profile(
+        (bucket + 1) * TTL_SECONDS - uid_phase(uid),
+        *(hashed_val(uid, label, bucket) for label in RANGES)
+    )
+
+
+def jittered_ttl() -> float:
+    return TTL_SECONDS * (1 - random.random() * TTL_JITTER)
+
+
+async def get_profile(uid: int) -> Profile:
+    """
+    Возвращает все значения пользователя одним обращением к кэшу.
+    В пределах STALE_GRACE после конца окна пользователю с аватаром возвращается
+    прежний профиль (expires_at уже в прошлом), а новый готовится в фоне вместе
+    с аватаром.
+    """
+    if STATS_MODE == "hash":
+        bucket = current_bucket(uid)
+        profile = hashed_profile(uid, bucket)
+        if STALE_GRACE and time.time() < profile.expires_at - TTL_SECONDS + STALE_GRACE:
+            previous = hashed_profile(uid, bucket - 1)
+            if (
+                uid in active_users
+                and (uid, *profile.stats) not in img_cache
+                and img_cache.peek_stale((uid, *previous.stats)) is not None
+                and schedule_refresh(uid, profile)
+            ):
+                cache.stale += 1
+                return previous
+        return profile
+
+    found = cache.get_stale(uid)
+    if found is not None:
+        profile, stale = found
+        if not stale:
+            return profile
+        # Прежний профиль нужен, только пока рисуется аватар нового окна;
+        # без аватара новый профиль создаётся сразу
+        if (
+            uid in active_users
+            and img_cache.peek_stale((uid, *profile.stats)) is not None
+            and schedule_refresh(uid, None)
+        ):
+            cache.stale += 1
+            return profile
+        cache.misses += 1
+
+    # Профиль в пределах окна не меняется, поэтому локальный кэш — это L1,
+    # а при нескольких воркерах значение согласуется через shared_state
+    try:
+        profile = await shared_state.get_or_create_profile(uid, lambda: staged_profile(uid) or new_profile())
+    except (RedisError, ConnectionError, OSError) as e:
+        log.error(f"Ошибка общего состояния: {e}. Профиль UID {uid} создаётся локально.")
+        profile = staged_profile(uid) or new_profile()
+    cache.set(uid, profile, expires_at=profile.expires_at)
+    return profile
 
-        if key in cache and now - cache[key][0] <= TTL:
-            _, v, e = cache[key]
-        else:
-            v, e = gens[label]()
-            cache[key] = (now, v, e)
-            # Сохраняем кэш асинхронно (не блокируя)
-            asyncio.create_task(save_cache_to_disk())
 
-        return v, e
+def new_profile() -> Profile:
+    return Profile(time.time() + jittered_ttl(), *(gens[label]()[0] for label in RANGES))
+
+
+def next_profile(uid: int, current: Profile) -> Profile:
+    """Профиль окна, которое начнётся после current (для предзагрузки)."""
+    if STATS_MODE == "hash":
+        return hashed_profile(uid, (int(current.expires_at) + uid_phase(uid)) // TTL_SECONDS)
+    return Profile(current.expires_at + jittered_ttl(), *(gens[label]()[0] for label in RANGES))
+
+
+def staged_profile(uid: int) -> Optional[Profile]:
+    """Забирает профиль, заранее подготовленный предзагрузкой, если он ещё действует."""
+    profile = upcoming_profiles.pop(uid)
+    if profile is not None and profile.expires_at > time.time():
+        return profile
+    return None
 
 
 # ─────────── Клавиатура ───────────
@@ -247,8 +1731,95 @@ KB = InlineKeyboardMarkup(inline_keyboard=[
 IMG_GEN_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-image:generateContent"
 
 
-async def gemini_png(session: aiohttp.ClientSession, prompt: str) -> bytes:
-    """Генерирует изображение через Gemini API."""
+# Ответ с картинкой читается кусками этого размера
+IMAGE_READ_CHUNK = 64 * 1024
+# Пиковый объём буферов при разборе ответов с картинкой, байт
+image_decode_peaks = {"generations": 0, "last": 0, "max": 0}
+
+
+class InlineImageDecoder:
+    """
+    Потоковый разбор ответа Gemini с картинкой.
+
+    Base64 из первого inlineData.data декодируется по мере прихода кусков сразу
+    в заранее выделенный буфер; остальной JSON копится как «скелет», где вместо
+    картинки пустая строка, и разбирается в конце. Так в памяти не бывает ни
+    тела ответа целиком, ни строки base64, ни лишних копий картинки.
+    """
+    DATA_RE = re.compile(rb'"inlineData"\s*:\s*\{[^{}]*?"data"\s*:\s*"')
+
+    def __init__(self, size_hint: int = 0):
+        # Декодированная картинка не больше 3/4 тела ответа
+        self.buf = bytearray(size_hint * 3 // 4 if size_hint else 1 << 20)
+        self.size = 0
+        self.peak = 0
+        self._skeleton = bytearray()
+        self._scan_from = 0
+        self._in_data = False
+        self._found = False
+        self._carry = b""
+
+    def feed(self, chunk: bytes):
+        while chunk:
+            if self._in_data:
+                # В base64 нет кавычек, поэтому первая кавычка закрывает строку
+                end = chunk.find(b'"')
+                self._decode(chunk if end < 0 else chunk[:end], final=end >= 0)
+                if end < 0:
+                    break
+                self._in_data = False
+                self._found = True
+                self._skeleton += b'"'
+                chunk = chunk[end + 1:]
+                continue
+            self._skeleton += chunk
+            chunk = b""
+            if not self._found:
+                m = self.DATA_RE.search(self._skeleton, self._scan_from)
+                if m:
+                    chunk = bytes(self._skeleton[m.end():])
+                    del self._skeleton[m.end():]
+                    self._in_data = True
+                else:
+                    # Начало ключа могло прийти в конце куска
+                    self._scan_from = max(0, len(self._skeleton) - 256)
+        self.peak = max(self.peak, len(self.buf) + len(self._skeleton) + len(self._carry))
+
+    def _decode(self, part: bytes, final: bool):
+        data, tail = self._carry + part, b""
+        # Экранирование (\/) могло разорваться границей куска
+        if not final and data.endswith(b"\\"):
+            data, tail = data[:-1], b"\\"
+        if b"\\" in data:
+            data = data.replace(b"\\/", b"/").replace(b"\\n", b"")
+        n = len(data) if final else len(data) // 4 * 4
+        self._carry = data[n:] + tail
+        if not n:
+            return
+        try:
+            decoded = binascii.a2b_base64(data[:n])
+        except binascii.Error as e:
+            raise RuntimeError(f"Битый base64 в ответе Gemini: {e}") from None
+        end = self.size + len(decoded)
+        if end > len(self.buf):
+            self.buf.extend(bytes(max(end - len(self.buf), len(self.buf))))
+        self.buf[self.size:end] = decoded
+        self.size = end
+
+    def finish(self) -> Tuple[dict, Optional[bytearray]]:
+        """Возвращает разобранный скелет ответа и картинку (или None)."""
+        if self._in_data:
+            raise RuntimeError("Ответ Gemini оборван посреди картинки")
+        data = json.loads(self._skeleton)
+        if not self._found:
+            return data, None
+        # Обрезка на месте, без копирования картинки
+        del self.buf[self.size:]
+        return data, self.buf
+
+
+async def gemini_png(session: aiohttp.ClientSession, prompt: str) -> bytearray:
+    """Генерирует изображение через Gemini API; ответ разбирается потоково."""
     if not GEMINI_API_KEY:
         raise RuntimeError("GEMINI_API_KEY не задан для генерации изображений.")
 
@@ -258,20 +1829,27 @@ async def gemini_png(session: aiohttp.ClientSession, prompt: str) -> bytes:
         "generationConfig": {"responseModalities": ["TEXT", "IMAGE"]}
     }
 
-    async with session.post(url, json=payload, timeout=30) as resp:
+    async with session.post(url, json=payload, timeout=http_timeout(30)) as resp:
         if resp.status != 200:
             text = await resp.text()
             log.error(f"Gemini image API HTTP Error {resp.status}: {text}")
             raise RuntimeError(f"Ошибка API: HTTP {resp.status}")
 
-        data = await resp.json()
+        decoder = InlineImageDecoder(resp.content_length or 0)
+        async for chunk in resp.content.iter_chunked(IMAGE_READ_CHUNK):
+            decoder.feed(chunk)
+        data, image = decoder.finish()
+
+    image_decode_peaks["generations"] += 1
+    image_decode_peaks["last"] = decoder.peak
+    image_decode_peaks["max"] = max(image_decode_peaks["max"], decoder.peak)
+    log.info(f"Ответ Gemini разобран: картинка {decoder.size} байт, пик буферов {decoder.peak} байт")
 
     if data["candidates"][0].get("finishReason") == "IMAGE_SAFETY":
         raise RuntimeError("IMAGE_SAFETY")
 
-    for part in data["candidates"][0]["content"]["parts"]:
-        if "inlineData" in part:
-            return base64.b64decode(part["inlineData"]["data"])
+    if image is not None:
+        return image
 
     raise RuntimeError("Нет изображения в ответе Gemini")
 
@@ -295,36 +1873,55 @@ def prompt_safe(ctx: dict) -> str:
     )
 
 
-async def make_image(ctx: dict) -> io.BytesIO:
+async def make_image(ctx: dict) -> bytearray:
     """Создаёт изображение через Gemini с fallback на безопасный промпт."""
-    async with aiohttp.ClientSession() as session:
+    session = get_http_session()
+    if not (await quotas.acquire("gemini_image"))[0]:
+        raise QuotaExceeded("квота генерации изображений исчерпана")
+    try:
+        data = await gemini_png(session, prompt_primary(ctx))
+    except RuntimeError as e:
+        if "IMAGE_SAFETY" in str(e):
+            log.warning("Основной промпт не прошел (IMAGE_SAFETY), пробуем безопасный.")
+            if not (await quotas.acquire("gemini_image"))[0]:
+                raise QuotaExceeded("квота генерации изображений исчерпана")
+            data = await gemini_png(session, prompt_safe(ctx))
+        else:
+            raise
+
+    return data
+
+
+PIL_FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+# Шрифт загружается один раз на поток: объект FreeType не разделяется между потоками
+_pil_local = threading.local()
+
+
+def _pil_font():
+    font = getattr(_pil_local, "font", None)
+    if font is None:
         try:
-            data = await gemini_png(session, prompt_primary(ctx))
-        except RuntimeError as e:
-            if "IMAGE_SAFETY" in str(e):
-                log.warning("Основной промпт не прошел (IMAGE_SAFETY), пробуем безопасный.")
-                data = await gemini_png(session, prompt_safe(ctx))
-            else:
-                raise
+            font = ImageFont.truetype(PIL_FONT_PATH, 18)
+        except IOError:
+            font = ImageFont.load_default()
+        _pil_local.font = font
+    return font
 
-    bio = io.BytesIO(data)
-    bio.seek(0)
-    return bio
 
+PIL_STAT_LABELS = ("Вес: ", "Длина: ", "IQ: ", "Рост: ")
 
-def render_pil(ctx: dict) -> io.BytesIO:
-    """Резервная генерация изображения через PIL."""
-    try:
-        font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 18)
-    except IOError:
-        font = ImageFont.load_default()
 
-    img = Image.new("RGB", (400, 400), "white")
+@functools.lru_cache(maxsize=1)
+def _pil_base() -> Tuple[Image.Image, Tuple[int, ...]]:
+    """
+    Статичная часть рисунка (голова, тело, руки, ноги, подписи статов) —
+    рисуется один раз. Возвращает шаблон и x-координаты значений статов.
+    """
+    font = _pil_font()
+    # Рисунок чёрно-белый, поэтому оттенки серого: меньше данных для кодирования
+    img = Image.new("L", (400, 400), "white")
     d = ImageDraw.Draw(img)
 
-    # Имя
-    d.text((10, 5), ctx["name"], font=font, fill="black")
-
     # Голова
     head, r = (200, 100), 40
     d.ellipse((head[0] - r, head[1] - r, head[0] + r, head[1] + r), outline="black", width=2)
@@ -340,23 +1937,126 @@ def render_pil(ctx: dict) -> io.BytesIO:
     d.line((200, 250, 170, 320), fill="black", width=2)
     d.line((200, 250, 230, 320), fill="black", width=2)
 
+    # Подписи статов
+    offsets = []
+    y = 330
+    for label in PIL_STAT_LABELS:
+        d.text((10, y), label, font=font, fill="black")
+        offsets.append(10 + round(d.textlength(label, font=font)))
+        y += 18
+    return img, tuple(offsets)
+
+
+def render_pil(ctx: dict) -> io.BytesIO:
+    """Резервная генерация изображения через PIL: шаблон + переменная часть."""
+    font = _pil_font()
+    base, offsets = _pil_base()
+    img = base.copy()
+    d = ImageDraw.Draw(img)
+
+    # Имя
+    d.text((10, 5), ctx["name"], font=font, fill="black")
+
     # Член (условно)
     d.line((200, 250, 200, 250 + ctx['c']), fill="black", width=2)
 
-    # Статы
+    # Значения статов — после подписей из шаблона
     y = 330
-    for t in (f"Вес: {ctx['w']} кг", f"Длина: {ctx['c']} см",
-              f"IQ: {ctx['iq']}", f"Рост: {ctx['h']} см"):
-        d.text((10, y), t, font=font, fill="black")
+    for x, t in zip(offsets, (f"{ctx['w']} кг", f"{ctx['c']} см",
+                              f"{ctx['iq']}", f"{ctx['h']} см")):
+        d.text((x, y), t, font=font, fill="black")
         y += 18
 
     bio = io.BytesIO()
-    img.save(bio, "PNG")
+    if PIL_FORMAT == "jpeg":
+        img.save(bio, "JPEG", quality=90)
+    else:
+        img.save(bio, "PNG", compress_level=PIL_PNG_COMPRESS_LEVEL)
     bio.seek(0)
     return bio
 
 
+class BufferReader(io.RawIOBase):
+    """
+    Файл только для чтения поверх bytes-like. io.BytesIO копирует bytearray
+    целиком, а здесь данные читаются прямо из буфера.
+    """
+
+    def __init__(self, data):
+        self._view = memoryview(data)
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = max(0, min(len(b), len(self._view) - self._pos))
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._view)}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            # Пока view жив, размер исходного bytearray менять нельзя
+            self._view.release()
+        super().close()
+
+
+def transcode_image(data: bytes) -> bytes:
+    """
+    Уменьшает изображение до AVATAR_MAX_DIM по большей стороне и пережимает в
+    AVATAR_FORMAT; прозрачность заливается белым. Выполняется в пуле CPU-задач.
+    Если уменьшать не нужно, а пережатый файл не меньше исходника, остаётся исходник.
+    """
+    target = "WEBP" if AVATAR_FORMAT == "webp" else "JPEG"
+    with BufferReader(data) as fp, Image.open(fp) as src:
+        if src.format == target and max(src.size) <= AVATAR_MAX_DIM:
+            return data
+        src.load()
+        if src.mode in ("RGBA", "LA") or (src.mode == "P" and "transparency" in src.info):
+            rgba = src.convert("RGBA")
+            img = Image.new("RGB", rgba.size, "white")
+            img.paste(rgba, mask=rgba.getchannel("A"))
+        elif src.mode in ("RGB", "L"):
+            img = src.copy()
+        else:
+            img = src.convert("RGB")
+
+    resized = max(img.size) > AVATAR_MAX_DIM
+    img.thumbnail((AVATAR_MAX_DIM, AVATAR_MAX_DIM), Image.LANCZOS)
+    out = io.BytesIO()
+    if target == "WEBP":
+        img.save(out, "WEBP", quality=AVATAR_QUALITY, method=4)
+    else:
+        img.save(out, "JPEG", quality=AVATAR_QUALITY, optimize=True)
+    result = out.getvalue()
+    return result if resized or len(result) < len(data) else data
+
+
 # ─────────── Хостинг изображений ───────────
+IMAGE_TYPES = {"png": "image/png", "jpg": "image/jpeg", "webp": "image/webp"}
+
+
+def image_ext(img_data: bytes) -> str:
+    """Расширение файла по сигнатуре изображения."""
+    if img_data[:3] == b"\xff\xd8\xff":
+        return "jpg"
+    if img_data[:4] == b"RIFF" and img_data[8:12] == b"WEBP":
+        return "webp"
+    return "png"
+
+
 async def upload_to_storage(img_data: bytes, filename: str) -> Optional[str]:
     """
     Storage Mode: Загружает изображение в Telegram канал.
@@ -400,10 +2100,10 @@ async def upload_to_http_server(
             'image',
             img_data,
             filename=filename,
-            content_type='image/png'
+            content_type=IMAGE_TYPES[image_ext(img_data)]
         )
 
-        async with session.post(upload_url, data=form, timeout=30) as resp:
+        async with session.post(upload_url, data=form, timeout=http_timeout(30)) as resp:
             if resp.status == 200:
                 result = await resp.json()
                 if result.get('success'):
@@ -422,71 +2122,592 @@ async def store_image(img_data: bytes, uid: int) -> Optional[str]:
     Сохраняет изображение согласно настроенному режиму хостинга.
     Возвращает file_id или URL, или None для In-Memory режима.
     """
-    filename = f"whoami_{uid}_{int(datetime.now().timestamp())}.png"
+    filename = f"whoami_{uid}_{int(datetime.now().timestamp())}.{image_ext(img_data)}"
 
     if STORAGE_CHAT_ID:
         return await upload_to_storage(img_data, filename)
 
     if IMAGE_SERVER_URL:
-        async with aiohttp.ClientSession() as session:
-            return await upload_to_http_server(session, img_data, filename)
+        return await upload_to_http_server(get_http_session(), img_data, filename)
+
+    return None  # In-Memory режим
+
+
+avatar_flight = SingleFlight("avatar")
+
+
+async def transcode_avatar(img_data: bytes) -> bytes:
+    """Пережимает аватар вне event loop; при ошибке оставляет исходные байты."""
+    if AVATAR_FORMAT not in ("jpeg", "webp"):
+        return img_data
+    started = time.monotonic()
+    try:
+        result = await cpu_pool.run(transcode_image, img_data)
+    except Exception as e:
+        log.warning(f"Не удалось пережать аватар: {e}")
+        return img_data
+    log.info(
+        f"Аватар пережат: {len(img_data)} → {len(result)} байт "
+        f"({image_ext(result)}, {(time.monotonic() - started) * 1000:.0f} мс)"
+    )
+    return result
+
+
+async def generate_avatar(key: tuple, ctx: dict, store: bool = True) -> Tuple[datetime, bytes, Optional[str]]:
+    """
+    Генерирует аватар (Gemini или PIL), сохраняет его и кладёт в img_cache.
+    store=False — не выкладывать в хостинг: file_id даст отправка в чат.
+    """
+    uid = ctx["uid"]
+    log.info(f"Генерация изображения для UID {uid}...")
+    try:
+        img_data = await make_image(ctx)
+    except QuotaExceeded as e:
+        log.info(f"Gemini: {e} → резервный PIL")
+        img_data = (await cpu_pool.run(render_pil, ctx)).getvalue()
+    except Exception as e:
+        log.error(f"Ошибка Gemini → резервный PIL: {e}")
+        img_data = (await cpu_pool.run(render_pil, ctx)).getvalue()
+    img_data = await transcode_avatar(img_data)
+
+    log.info(f"Изображение сгенерировано ({len(img_data)} байт).")
+    # Storage/HTTP Mode: отдаём Telegram file_id или URL вместо байтов
+    file_id = await store_image(img_data, uid) if store else None
+    entry = (datetime.now(), img_data, file_id)
+    img_cache.set(key, entry)
+    if file_id:
+        state_persister.mark_dirty(("file_id", key))
+        await publish_avatar(key, file_id, entry[0].timestamp() + TTL_SECONDS)
+    return entry
+
+
+async def obtain_avatar(
+    key: tuple,
+    ctx: dict,
+    reuse_shared: bool = True,
+    interactive: bool = False
+) -> Tuple[datetime, Optional[bytes], Optional[str]]:
+    """
+    Межпроцессный single-flight: если аватар уже генерирует другой воркер,
+    ждём его file_id вместо повторного вызова Gemini.
+    reuse_shared=False — опубликованный file_id известен как недействительный.
+    interactive=True — аватар сразу отправят в чат: если file_id ещё нет,
+    блокировка остаётся до publish_avatar после отправки.
+    """
+    skey = avatar_key_str(key)
+    deadline = time.monotonic() + AVATAR_FLIGHT_TTL
+    # Загрузка в канал-хранилище идёт в общей очереди с интервалом канала
+    # и низким приоритетом, поэтому тот, кто ждёт фото, её не ждёт: file_id
+    # даст сама отправка в чат
+    store = not (interactive and STORAGE_CHAT_ID)
+    try:
+        while time.monotonic() < deadline:
+            file_id = await shared_state.get_file_id(skey) if reuse_shared else None
+            if file_id:
+                entry = (datetime.now(), None, file_id)
+                img_cache.set(key, entry)
+                return entry
+            if await shared_state.acquire_flight(skey, AVATAR_FLIGHT_TTL):
+                break
+            await asyncio.sleep(AVATAR_FLIGHT_POLL)
+        else:
+            log.warning(f"Не дождались аватар {skey} от другого воркера, генерируем сами.")
+    except (RedisError, ConnectionError, OSError) as e:
+        log.error(f"Ошибка общего состояния: {e}. Генерируем без координации.")
+        return await generate_avatar(key, ctx, store)
+
+    entry = None
+    try:
+        entry = await generate_avatar(key, ctx, store)
+        return entry
+    finally:
+        # С file_id блокировку уже сняла publish_avatar. Без хостинга file_id
+        # появится только после отправки; фоновые генерации (обновление окна,
+        # предзагрузка) ничего не отправляют и снимают её сразу, как и ошибка
+        if entry is None or not (interactive or entry[2]):
+            await release_avatar_flight(skey)
+
+
+async def publish_avatar(key: tuple, file_id: str, expires_at: float):
+    """Делится file_id с другими воркерами и снимает блокировку генерации."""
+    skey = avatar_key_str(key)
+    try:
+        await shared_state.set_file_id(skey, file_id, expires_at)
+    except (RedisError, ConnectionError, OSError) as e:
+        log.error(f"Не удалось опубликовать file_id {skey}: {e}")
+    await release_avatar_flight(skey)
+
+
+async def release_avatar_flight(skey: str):
+    try:
+        await shared_state.release_flight(skey)
+    except (RedisError, ConnectionError, OSError) as e:
+        log.error(f"Не удалось снять блокировку {skey}: {e}")
+
+
+class AvatarQueue:
+    """
+    Очередь фоновой генерации аватаров: не больше workers генераций
+    одновременно, не больше queue_max ожидающих. Нажатие кнопки подтверждается
+    сразу, а фото отправляется в чат, когда готово.
+    """
+
+    def __init__(self, workers: int, queue_max: int):
+        self.workers = workers
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_max)
+        self._pending: set = set()
+        self._tasks: List[asyncio.Task] = []
+        self.active = 0
+        self.done = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def is_pending(self, tag) -> bool:
+        return tag in self._pending
+
+    def claim(self, tag) -> bool:
+        """Занимает tag до постановки в очередь; False — такое задание уже есть."""
+        if tag in self._pending:
+            return False
+        self._pending.add(tag)
+        return True
+
+    def release(self, tag):
+        self._pending.discard(tag)
+
+    def full(self) -> bool:
+        return self._queue.full()
+
+    def position(self) -> int:
+        """Сколько генераций придётся ждать новому заданию (0 — начнётся сразу)."""
+        return self._queue.qsize() + (1 if self.active >= self.workers else 0)
+
+    def submit(self, tag, job: Callable[[], Awaitable]) -> bool:
+        """Ставит задание в очередь; False — очередь переполнена."""
+        try:
+            self._queue.put_nowait((tag, job, time.monotonic()))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            self._pending.discard(tag)
+            return False
+        self._pending.add(tag)
+        return True
+
+    async def _worker(self):
+        while True:
+            tag, job, enqueued = await self._queue.get()
+            self.active += 1
+            self.wait_total += time.monotonic() - enqueued
+            try:
+                await job()
+                self.done += 1
+            except Exception as e:
+                self.failed += 1
+                log.error(f"Ошибка фоновой генерации аватара: {e}", exc_info=True)
+            finally:
+                self.active -= 1
+                self._pending.discard(tag)
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        started = self.done + self.failed + self.active
+        return {
+            "queued": self._queue.qsize(),
+            "active": self.active,
+            "done": self.done,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "wait_avg_ms": round(self.wait_total / started * 1000, 1) if started else 0.0,
+        }
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+avatar_queue = AvatarQueue(AVATAR_WORKERS, AVATAR_QUEUE_MAX)
+
+
+def schedule_refresh(uid: int, upcoming: Optional[Profile]) -> bool:
+    """
+    Ставит подготовку нового окна в очередь аватаров (один раз на пользователя).
+    False — очередь переполнена, и прежний профиль отдавать не стоит.
+    """
+    tag = ("refresh", uid)
+    if avatar_queue.is_pending(tag) or avatar_queue.submit(tag, lambda: refresh_window(uid, upcoming)):
+        return True
+    log.warning(f"Очередь аватаров переполнена, новое окно UID {uid} без ожидания аватара.")
+    return False
+
+
+async def refresh_window(uid: int, upcoming: Optional[Profile]):
+    """Готовит профиль и аватар нового окна, пока пользователю отдаётся прежний."""
+    if upcoming is None:
+        upcoming = await shared_state.get_or_create_profile(uid, lambda: staged_profile(uid) or new_profile())
+
+    w, c, iq, h = upcoming.stats
+    key = (uid, w, c, iq, h)
+    name = active_users.get(uid)
+    if name is not None and key not in img_cache:
+        ctx = {"w": w, "c": c, "iq": iq, "h": h, "name": name, "uid": uid}
+        await avatar_flight.do(key, lambda: obtain_avatar(key, ctx))
+
+    # Переключаемся на новый профиль, только когда его аватар готов
+    if STATS_MODE != "hash":
+        cache.set(uid, upcoming, expires_at=upcoming.expires_at)
+        state_persister.mark_dirty(("profile", uid))
+
+
+class AvatarPrefetcher:
+    """
+    Незадолго до конца окна заранее готовит значения и аватар следующего окна
+    для пользователей, чей аватар есть в img_cache, — тогда первое нажатие
+    «Кто я» в новом окне попадает в кэш. Работает только на свободной квоте
+    и уступает интерактивным запросам: пока очередь аватаров занята, ждёт.
+    """
+
+    def __init__(self, lead: int, interval: int, share: float, max_per_round: int, reserve: int):
+        self.lead = lead
+        self.interval = interval
+        self.share = share
+        self.max_per_round = max_per_round
+        self.reserve = reserve
+        self._done: Dict[int, float] = {}  # uid → конец окна, для которого всё готово
+        self._date = ""
+        self.calls_today = 0
+        self.refreshed = 0
+        self.yielded = 0
+        self.no_quota = 0
+
+    def _has_spare_quota(self) -> bool:
+        today = datetime.utcnow().strftime("%Y-%m-%d")
+        if today != self._date:
+            self._date = today
+            self.calls_today = 0
+        quota = quotas.quotas["gemini_image"]
+        if quota.per_day and self.calls_today >= quota.per_day * self.share:
+            return False
+        return not quotas.would_exceed("gemini_image", reserve=self.reserve)
+
+    def candidates(self) -> List[Tuple[float, int, Profile]]:
+        """(конец окна, uid, профиль) для активных пользователей, чьё окно скоро закончится."""
+        now = time.time()
+        found = {}
+        for key, _, _ in img_cache.items():
+            uid = key[0]
+            if uid in found or self._done.get(uid, 0) > now:
+                continue
+            if STATS_MODE == "hash":
+                profile = hashed_profile(uid, current_bucket(uid))
+            else:
+                entry = cache.peek(uid)
+                profile = entry[0] if entry is not None else None
+            # Аватар должен относиться к текущему окну пользователя
+            if profile is None or key[1:] != profile.stats:
+                continue
+            if now < profile.expires_at <= now + self.lead:
+                found[uid] = profile
+        return sorted((p.expires_at, uid, p) for uid, p in found.items())
+
+    async def refresh(self, uid: int, name: str, current: Profile):
+        upcoming = next_profile(uid, current)
+        if STATS_MODE != "hash":
+            upcoming_profiles.set(uid, upcoming, expires_at=upcoming.expires_at)
+        self._done[uid] = upcoming.expires_at
+
+        w, c, iq, h = upcoming.stats
+        key = (uid, w, c, iq, h)
+        if img_cache.peek(key) is not None:
+            return
+        ctx = {"w": w, "c": c, "iq": iq, "h": h, "name": name, "uid": uid}
+        entry = await avatar_flight.do(key, lambda: obtain_avatar(key, ctx))
+        # Аватар следующего окна должен дожить до его конца
+        img_cache.set(key, entry, expires_at=upcoming.expires_at)
+        self.calls_today += 1
+        self.refreshed += 1
+
+    async def run_once(self):
+        started = 0
+        for _, uid, profile in self.candidates():
+            if started >= self.max_per_round:
+                break
+            name = active_users.get(uid)
+            if name is None:
+                continue
+            if avatar_queue.position() > 0 or avatar_queue.active:
+                self.yielded += 1
+                break
+            if not self._has_spare_quota():
+                self.no_quota += 1
+                break
+            started += 1
+            try:
+                await self.refresh(uid, name, profile)
+            except Exception as e:
+                log.warning(f"Предзагрузка для UID {uid} не удалась: {e}")
+
+        now = time.time()
+        if len(self._done) > STATS_CACHE_MAX_ENTRIES:
+            self._done = {uid: exp for uid, exp in self._done.items() if exp > now}
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                log.warning(f"Ошибка предзагрузки аватаров: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "refreshed": self.refreshed,
+            "calls_today": self.calls_today,
+            "yielded": self.yielded,
+            "no_quota": self.no_quota,
+        }
+
+
+prefetcher = AvatarPrefetcher(
+    PREFETCH_LEAD, PREFETCH_INTERVAL, PREFETCH_SHARE, PREFETCH_MAX_PER_ROUND, PREFETCH_RESERVE
+)
+
+
+async def check_api_limit_and_increment() -> Tuple[bool, str]:
+    """Проверяет и обновляет дневной лимит использования API."""
+    allowed, count = await quotas.acquire("search")
+    if not allowed:
+        log.warning(f"Дневной лимит ({SEARCH_API_DAILY_LIMIT}) исчерпан.")
+        return False, f"Дневной лимит ({SEARCH_API_DAILY_LIMIT}) исчерпан. Попробуйте завтра."
+
+    log.info(f"API: {count}/{SEARCH_API_DAILY_LIMIT}")
+    return True, ""
+
+
+# ─────────── Поиск и парсинг ───────────
+class TextCollector:
+    """
+    Target для потокового парсера lxml: собирает видимый текст, пропуская
+    содержимое script/style/nav и т.п. прямо во время разбора, без дерева.
+    """
 
-    return None  # In-Memory режим
+    SKIP_TAGS = {"script", "style", "noscript", "header", "footer", "nav", "aside"}
 
+    def __init__(self):
+        self.lines: List[str] = []
+        self.size = 0
+        self._skip_depth = 0
+        self._buf: List[str] = []
 
+    def _flush(self):
+        if self._buf:
+            line = " ".join("".join(self._buf).split())
+            self._buf = []
+            if line:
+                self.lines.append(line)
+                self.size += len(line) + 1
 
-async def check_api_limit_and_increment() -> Tuple[bool, str]:
-    """Проверяет и обновляет дневной лимит использования API."""
-    async with api_usage_lock:
-        today_str = datetime.utcnow().strftime("%Y-%m-%d")
-        usage_data = {"date": today_str, "count": 0}
+    def start(self, tag, attrib):
+        self._flush()
+        if tag in self.SKIP_TAGS:
+            self._skip_depth += 1
 
-        try:
-            if API_USAGE_FILE.exists():
-                with open(API_USAGE_FILE, 'r') as f:
-                    usage_data = json.load(f)
-        except (json.JSONDecodeError, Exception) as e:
-            log.info(f"Файл {API_USAGE_FILE} не найден или пуст: {e}")
+    def end(self, tag):
+        self._flush()
+        if tag in self.SKIP_TAGS and self._skip_depth:
+            self._skip_depth -= 1
 
-        if usage_data.get("date") != today_str:
-            log.info(f"Новый день. Сбрасываем счетчик API.")
-            usage_data = {"date": today_str, "count": 0}
+    def data(self, text):
+        if not self._skip_depth:
+            self._buf.append(text)
 
-        if usage_data["count"] >= SEARCH_API_DAILY_LIMIT:
-            log.warning(f"Дневной лимит ({SEARCH_API_DAILY_LIMIT}) исчерпан.")
-            return False, f"Дневной лимит ({SEARCH_API_DAILY_LIMIT}) исчерпан. Попробуйте завтра."
+    def close(self):
+        self._flush()
+        return "\n".join(self.lines)
 
-        usage_data["count"] += 1
 
-        with open(API_USAGE_FILE, 'w') as f:
-            json.dump(usage_data, f)
+class PageCache:
+    """
+    Дисковый кэш извлечённого текста страниц: URL → (текст, ETag, Last-Modified).
+    Суммарный размер текста ограничен max_bytes; при переполнении вытесняются
+    записи, которые дольше всего не читались.
+    """
 
-        log.info(f"API: {usage_data['count']}/{SEARCH_API_DAILY_LIMIT}")
-        return True, ""
+    def __init__(self, path, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            " url TEXT PRIMARY KEY, text TEXT NOT NULL, etag TEXT, last_modified TEXT,"
+            " fetched_at REAL NOT NULL, used_at REAL NOT NULL, size INTEGER NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS pages_used_at ON pages (used_at)")
+        self._db.commit()
+        self.bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+
+    def get(self, url: str) -> Optional[Tuple[str, Optional[str], Optional[str], float]]:
+        """Возвращает (текст, ETag, Last-Modified, время загрузки) или None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT text, etag, last_modified, fetched_at FROM pages WHERE url = ?", (url,)
+            ).fetchone()
+            if row is not None:
+                with self._db:
+                    self._db.execute("UPDATE pages SET used_at = ? WHERE url = ?", (time.time(), url))
+        return row
+
+    def put(self, url: str, text: str, etag: Optional[str], last_modified: Optional[str]) -> None:
+        size = len(text.encode())
+        now = time.time()
+        with self._lock:
+            with self._db:
+                old = self._db.execute("SELECT size FROM pages WHERE url = ?", (url,)).fetchone()
+                self._db.execute(
+                    "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (url, text, etag, last_modified, now, now, size)
+                )
+                self.bytes += size - (old[0] if old else 0)
+                while self.bytes > self.max_bytes:
+                    victims = self._db.execute(
+                        "SELECT url, size FROM pages WHERE url != ? ORDER BY used_at LIMIT 100", (url,)
+                    ).fetchall()
+                    if not victims:
+                        break
+                    for victim, victim_size in victims:
+                        self._db.execute("DELETE FROM pages WHERE url = ?", (victim,))
+                        self.bytes -= victim_size
+                        self.evictions += 1
+                        if self.bytes <= self.max_bytes:
+                            break
+
+    def touch(self, url: str) -> None:
+        """Отмечает, что страница перепроверена (304) и снова свежая."""
+        with self._lock:
+            with self._db:
+                self._db.execute("UPDATE pages SET fetched_at = ? WHERE url = ?", (time.time(), url))
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+        return {
+            "entries": entries,
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+# При STATE_BACKEND=memory кэш страниц тоже не переживает перезапуск
+page_cache = PageCache(":memory:" if STATE_BACKEND == "memory" else PAGE_CACHE_FILE, PAGE_CACHE_MAX_BYTES)
+# URL → причина неудачи; такие страницы не тормозят следующий /proof
+page_failures = TTLCache("page_failures", PAGE_FAIL_TTL, max_entries=PROOF_CACHE_MAX_ENTRIES)
+
+
+async def parse_on_pool(fn: Callable, *args):
+    """
+    Разбор в пуле CPU-задач. Таймаут пула тоже означает его перегрузку и
+    отличается от сетевого таймаута, поэтому поднимается как CpuPoolBusy.
+    """
+    try:
+        return await cpu_pool.run(fn, *args)
+    except asyncio.TimeoutError:
+        raise CpuPoolBusy(f"Пул CPU-задач не успел разобрать страницу ({fn.__name__})") from None
 
 
-# ─────────── Поиск и парсинг ───────────
 async def fetch_and_parse_url(session: aiohttp.ClientSession, url: str) -> str:
-    """Скачивает и парсит HTML-страницу, возвращая чистый текст."""
+    """
+    Скачивает HTML-страницу потоково и возвращает чистый текст.
+    Чтение прекращается, как только набрано PROOF_SOURCE_CHARS символов текста
+    или скачано PROOF_PAGE_MAX_BYTES байт.
+
+    Текст кэшируется на диске: свежая запись отдаётся без запроса, устаревшая
+    перепроверяется условным запросом, и ответ 304 обходится без разбора.
+    """
+    cached = await asyncio.to_thread(page_cache.get, url)
+    reason = page_failures.get(url)
+    if reason is not None:
+        log.info(f"Пропускаю {url}: недавняя ошибка ({reason})")
+        # Устаревший текст лучше, чем никакого
+        return cached[0] if cached is not None else ""
+
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
     }
-    try:
-        async with session.get(url, headers=headers, timeout=10) as resp:
-            resp.raise_for_status()
-            html_text = await resp.text()
-
-        soup = BeautifulSoup(html_text, 'lxml')
+    if cached is not None:
+        text, etag, last_modified, fetched_at = cached
+        if time.time() - fetched_at < PAGE_CACHE_FRESH:
+            page_cache.hits += 1
+            return text
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
 
-        for tag in soup(['script', 'style', 'header', 'footer', 'nav', 'aside']):
-            tag.decompose()
+    try:
+        async with session.get(url, headers=headers, timeout=http_timeout(10)) as resp:
+            if resp.status == 304 and cached is not None:
+                page_cache.revalidated += 1
+                await asyncio.to_thread(page_cache.touch, url)
+                log.info(f"{url}: не изменилась (304)")
+                return cached[0]
 
-        text = soup.get_text(separator='\n', strip=True)
-        return "\n".join(line.strip() for line in text.splitlines() if line.strip())
+            resp.raise_for_status()
+            page_cache.misses += 1
+
+            content_type = resp.headers.get("Content-Type", "").lower()
+            if content_type and "html" not in content_type:
+                log.info(f"Пропускаю {url}: {content_type}")
+                page_failures.set(url, content_type)
+                return ""
+
+            collector = TextCollector()
+            parser = etree.HTMLParser(target=collector, encoding=resp.charset)
+            received = 0
+            # Парсер хранит состояние, поэтому в другой процесс его не передать:
+            # в пуле потоков куски разбираются вне event loop, в режиме process — в нём
+            offload = cpu_pool.kind != "process"
+            async for chunk in resp.content.iter_chunked(PROOF_PAGE_CHUNK):
+                received += len(chunk)
+                if offload:
+                    await parse_on_pool(parser.feed, chunk)
+                else:
+                    parser.feed(chunk)
+                if collector.size >= PROOF_SOURCE_CHARS or received >= PROOF_PAGE_MAX_BYTES:
+                    break
+
+            text = await parse_on_pool(parser.close) if offload else parser.close()
+            etag = resp.headers.get("ETag")
+            last_modified = resp.headers.get("Last-Modified")
+
+        log.info(f"{url}: прочитано {received} байт, текста {collector.size} символов")
+        await asyncio.to_thread(page_cache.put, url, text, etag, last_modified)
+        return text
 
+    except CpuPoolBusy as e:
+        # Перегрузка у нас, а не у страницы — в page_failures не записываем
+        log.warning(f"Пропускаю {url}: {e}")
+        return cached[0] if cached is not None else ""
     except Exception as e:
-        log.error(f"Ошибка парсинга {url}: {e}")
-        return ""
+        log.error(f"Ошибка парсинга {url}: {e!r}")
+        page_failures.set(url, type(e).__name__)
+        return cached[0] if cached is not None else ""
 
 
 async def search_google(session: aiohttp.ClientSession, query: str) -> list:
@@ -505,7 +2726,7 @@ async def search_google(session: aiohttp.ClientSession, query: str) -> list:
     }
 
     try:
-        async with session.get(search_url, params=params, timeout=10) as resp:
+        async with session.get(search_url, params=params, timeout=http_timeout(10)) as resp:
             resp.raise_for_status()
             search_results = await resp.json()
 
@@ -523,7 +2744,9 @@ async def search_google(session: aiohttp.ClientSession, query: str) -> list:
 
 # ─────────── Gemini текстовая генерация ───────────
 TEXT_GEN_URL_TEMPLATE = "https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent"
+TEXT_STREAM_URL_TEMPLATE = "https://generativelanguage.googleapis.com/v1beta/models/{model_name}:streamGenerateContent"
 DEFAULT_TEXT_MODEL = "gemini-1.5-flash-latest"
+GEMINI_QUOTA_MSG = "Лимит запросов к Gemini исчерпан. Попробуйте позже."
 
 
 async def get_clean_search_query(
@@ -542,6 +2765,10 @@ async def get_clean_search_query(
         "Поисковый запрос:"
     )
 
+    if not (await quotas.acquire("gemini_text"))[0]:
+        log.warning("Квота Gemini исчерпана, запрос не очищается")
+        return text
+
     url = TEXT_GEN_URL_TEMPLATE.format(model_name=model_name) + f"?key={GEMINI_API_KEY}"
     payload = {
         "contents": [{"parts": [{"text": prompt}]}],
@@ -549,7 +2776,7 @@ async def get_clean_search_query(
     }
 
     try:
-        async with session.post(url, json=payload, timeout=10) as resp:
+        async with session.post(url, json=payload, timeout=http_timeout(10)) as resp:
             resp.raise_for_status()
             data = await resp.json()
 
@@ -562,16 +2789,8 @@ async def get_clean_search_query(
         return text
 
 
-async def summarize_with_gemini(
-    session: aiohttp.ClientSession,
-    original_query: str,
-    search_context: Optional[str],
-    model_name: str = DEFAULT_TEXT_MODEL
-) -> str:
-    """Суммаризирует информацию с Gemini."""
-    if not GEMINI_API_KEY:
-        raise RuntimeError("GEMINI_API_KEY не задан.")
-
+def summary_payload(original_query: str, search_context: Optional[str]) -> dict:
+    """Собирает запрос к Gemini для ответа /proof (с источниками или без)."""
     if search_context:
         prompt = (
             "Ты — ИИ-ассистент, анализирующий поисковую выдачу.\n"
@@ -593,8 +2812,7 @@ async def summarize_with_gemini(
             f"Запрос: \"{original_query}\""
         )
 
-    url = TEXT_GEN_URL_TEMPLATE.format(model_name=model_name) + f"?key={GEMINI_API_KEY}"
-    payload = {
+    return {
         "contents": [{"parts": [{"text": prompt}]}],
         "generationConfig": {"temperature": 0.3},
         "safetySettings": [
@@ -605,8 +2823,30 @@ async def summarize_with_gemini(
         ]
     }
 
+
+async def summarize_with_gemini(
+    session: aiohttp.ClientSession,
+    original_query: str,
+    search_context: Optional[str],
+    model_name: str = DEFAULT_TEXT_MODEL,
+    timeout: float = 90
+) -> Tuple[str, bool]:
+    """Суммаризирует информацию с Gemini.
+
+    Возвращает текст ответа и признак успеха: сообщения об ошибках не кэшируются.
+    """
+    if not GEMINI_API_KEY:
+        raise RuntimeError("GEMINI_API_KEY не задан.")
+
+    if not (await quotas.acquire("gemini_text"))[0]:
+        log.warning("Квота Gemini исчерпана")
+        return GEMINI_QUOTA_MSG, False
+
+    url = TEXT_GEN_URL_TEMPLATE.format(model_name=model_name) + f"?key={GEMINI_API_KEY}"
+    payload = summary_payload(original_query, search_context)
+
     try:
-        async with session.post(url, json=payload, timeout=90) as resp:
+        async with session.post(url, json=payload, timeout=http_timeout(timeout)) as resp:
             resp.raise_for_status()
             data = await resp.json()
 
@@ -614,18 +2854,47 @@ async def summarize_with_gemini(
         if candidates and candidates[0].get("content"):
             parts = candidates[0]["content"].get("parts", [])
             if parts and parts[0].get("text"):
-                return parts[0]["text"].strip()
+                return parts[0]["text"].strip(), True
 
         log.error(f"Неожиданный ответ Gemini: {data}")
-        return "Не удалось получить ответ от Gemini."
+        return "Не удалось получить ответ от Gemini.", False
 
     except aiohttp.ClientResponseError as e:
         log.error(f"HTTP ошибка Gemini: {e}")
-        return f"Ошибка API ({e.status})."
+        return f"Ошибка API ({e.status}).", False
 
     except Exception as e:
         log.error(f"Ошибка Gemini: {e}", exc_info=True)
-        return "Произошла ошибка при обработке запроса."
+        return "Произошла ошибка при обработке запроса.", False
+
+
+async def stream_summary_with_gemini(
+    session: aiohttp.ClientSession,
+    original_query: str,
+    search_context: Optional[str],
+    model_name: str = DEFAULT_TEXT_MODEL,
+    timeout: float = 90
+) -> AsyncIterator[str]:
+    """Потоково отдаёт фрагменты ответа Gemini (streamGenerateContent, SSE)."""
+    if not GEMINI_API_KEY:
+        raise RuntimeError("GEMINI_API_KEY не задан.")
+
+    if not (await quotas.acquire("gemini_text"))[0]:
+        raise QuotaExceeded(GEMINI_QUOTA_MSG)
+
+    url = TEXT_STREAM_URL_TEMPLATE.format(model_name=model_name) + f"?alt=sse&key={GEMINI_API_KEY}"
+    payload = summary_payload(original_query, search_context)
+
+    async with session.post(url, json=payload, timeout=http_timeout(timeout)) as resp:
+        resp.raise_for_status()
+        async for line in resp.content:
+            if not line.startswith(b"data:"):
+                continue
+            candidates = json.loads(line[5:]).get("candidates", [])
+            if candidates and candidates[0].get("content"):
+                for part in candidates[0]["content"].get("parts", []):
+                    if part.get("text"):
+                        yield part["text"]
 
 
 # ─────────── Обработчики команд ───────────
@@ -676,54 +2945,38 @@ async def callbacks(cb: types.CallbackQuery):
     chat_id = cb.message.chat.id
     act = cb.data
 
+    # Отправка в чат может ждать в очереди исходящих дольше, чем живёт callback,
+    # поэтому нажатие подтверждается первым
     if act == "proof_help":
+        await cb.answer()
         await cb.message.answer(
             "Чтобы я поискал информацию:\n"
             "— /proof ваш текст\n"
             "— Или ответьте на сообщение командой /proof",
             parse_mode=None
         )
-        await cb.answer()
         return
 
     if act in ("weight", "cock", "iq", "height"):
         act_rus = {"weight": "вес", "cock": "хуй", "iq": "IQ", "height": "рост"}
-        val, emo = await cached_val(uid, act)
+        val, emo = (await get_profile(uid)).get(act)
         unit = "кг" if act == "weight" else "см"
+        await cb.answer()
         await bot.send_message(
             chat_id,
             f"{name}, ваш {act_rus[act]}: {val} {unit} {emo}",
             parse_mode=None
         )
-        await cb.answer()
         return
 
     if act == "whoami":
-        w, wt = await cached_val(uid, "weight")
-        c, ct = await cached_val(uid, "cock")
-        iq, iqt = await cached_val(uid, "iq")
-        h, ht = await cached_val(uid, "height")
-        ctx = {"w": w, "c": c, "iq": iq, "h": h, "name": name}
-
-        now = datetime.now()
-        img_data: bytes
-
-        if uid in img_cache and now - img_cache[uid][0] <= TTL:
-            log.info(f"Изображение для UID {uid} из кэша.")
-            img_data = img_cache[uid][1]
-        else:
-            log.info(f"Генерация изображения для UID {uid}...")
-            try:
-                bio = await make_image(ctx)
-                img_data = bio.getvalue()
-            except Exception as e:
-                log.error(f"Ошибка Gemini → резервный PIL: {e}")
-                bio = render_pil(ctx)
-                img_data = bio.getvalue()
-
-            img_cache[uid] = (now, img_data)
-            log.info(f"Изображение сгенерировано ({len(img_data)} байт).")
+        p = await get_profile(uid)
+        w, c, iq, h = p.stats
+        wt, ct, iqt, ht = p.wt, p.ct, p.iqt, p.ht
+        ctx = {"w": w, "c": c, "iq": iq, "h": h, "name": name, "uid": uid}
 
+        key = (uid, w, c, iq, h)
+        active_users.set(uid, name)
         caption = (
             f"Мой вес: {w} кг {wt}\n"
             f"Мой хуй: {c} см {ct}\n"
@@ -731,13 +2984,371 @@ async def callbacks(cb: types.CallbackQuery):
             f"Мой рост: {h} см {ht}"
         )
 
-        await bot.send_photo(
-            chat_id,
-            BufferedInputFile(img_data, "whoami.png"),
-            caption=caption,
-            parse_mode=None
+        # В пределах STALE_GRACE годится и истёкшая запись: аватар зависит только от значений
+        found = img_cache.get_stale(key)
+        if found is not None:
+            cached, stale = found
+            if stale:
+                img_cache.stale += 1
+            log.info(f"Изображение для UID {uid} из кэша.")
+            await cb.answer()
+            await deliver_avatar(chat_id, key, ctx, caption, cached)
+            return
+
+        # Генерация занимает до десятков секунд — кнопку отпускаем сразу
+        tag = (chat_id, key)
+        # Занимаем tag до первого await, иначе двойное нажатие пройдёт проверку дважды
+        if not avatar_queue.claim(tag):
+            await cb.answer("Аватар уже рисуется…")
+            return
+        if avatar_queue.full():
+            avatar_queue.release(tag)
+            avatar_queue.rejected += 1
+            await cb.answer("Слишком много желающих, попробуйте через минуту.", show_alert=True)
+            return
+        try:
+            await cb.answer("Рисую аватар…")
+
+            position = avatar_queue.position()
+            placeholder = None
+            if AVATAR_QUEUE_NOTICE and position >= AVATAR_QUEUE_NOTICE:
+                placeholder = await bot.send_message(
+                    chat_id, f"⏳ {name}, аватар в очереди, перед вами: {position}.", parse_mode=None
+                )
+        except BaseException:
+            avatar_queue.release(tag)
+            raise
+        queued = avatar_queue.submit(
+            tag, lambda: deliver_avatar(chat_id, key, ctx, caption, placeholder=placeholder)
         )
-        await cb.answer()
+        if not queued:
+            text = f"{name}, очередь переполнена, попробуйте через минуту."
+            if placeholder is not None:
+                await placeholder.edit_text(text, parse_mode=None)
+            else:
+                await bot.send_message(chat_id, text, parse_mode=None)
+
+
+async def deliver_avatar(
+    chat_id: int,
+    key: tuple,
+    ctx: dict,
+    caption: str,
+    cached: Optional[Tuple[datetime, Optional[bytes], Optional[str]]] = None,
+    placeholder: Optional[types.Message] = None
+):
+    """Получает аватар (из кэша или генерацией) и отправляет его в чат."""
+    # Блокировку генерации без file_id снимает publish_avatar после отправки
+    generated = False
+    file_id = None
+    try:
+        if cached is None:
+            generated = True
+            # Одновременные запросы ждут одну и ту же генерацию
+            cached = await avatar_flight.do(key, lambda: obtain_avatar(key, ctx, interactive=True))
+            # Общий результат генерации не знает file_id, полученный первой отправкой
+            current = img_cache.peek(key)
+            if current is not None:
+                cached = current[0]
+        ts, img_data, file_id = cached
+
+        try:
+            msg = await send_avatar(chat_id, img_data, file_id, caption)
+        except TelegramBadRequest:
+            if img_data is not None:
+                raise
+            # file_id из хранилища устарел, а байтов после рестарта нет — генерируем заново
+            img_cache.pop(key)
+            generated = True
+            ts, img_data, file_id = await avatar_flight.do(
+                key, lambda: obtain_avatar(key, ctx, reuse_shared=False, interactive=True)
+            )
+            msg = await send_avatar(chat_id, img_data, file_id, caption)
+    except Exception:
+        if generated and not file_id:
+            await release_avatar_flight(avatar_key_str(key))
+        if placeholder is not None:
+            await placeholder.edit_text("Не удалось нарисовать аватар, попробуйте позже.", parse_mode=None)
+        raise
+
+    if placeholder is not None:
+        try:
+            await placeholder.delete()
+        except TelegramBadRequest as e:
+            log.debug(f"Не удалось удалить сообщение очереди: {e}")
+
+    if msg.photo and msg.photo[-1].file_id != file_id:
+        # Повторные отправки в пределах TTL идут по file_id без загрузки файла;
+        # срок записи сохраняется (у предзагруженного аватара он дальше ts + TTL)
+        current = img_cache.peek(key)
+        expires_at = current[1] if current is not None else ts.timestamp() + TTL_SECONDS
+        img_cache.set(key, (ts, img_data, msg.photo[-1].file_id), expires_at=expires_at)
+        state_persister.mark_dirty(("file_id", key))
+        await publish_avatar(key, msg.photo[-1].file_id, expires_at)
+    elif generated and not file_id:
+        await release_avatar_flight(avatar_key_str(key))
+
+
+async def send_avatar(
+    chat_id: int,
+    img_data: Optional[bytes],
+    file_id: Optional[str],
+    caption: str
+) -> types.Message:
+    """Отправляет аватар по file_id/URL, а при его недоступности — файлом."""
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id, file_id, caption=caption, parse_mode=None)
+        except TelegramBadRequest as e:
+            if img_data is None:
+                raise
+            log.warning(f"file_id недействителен ({e}), отправляю файл заново.")
+
+    return await bot.send_photo(
+        chat_id,
+        BufferedInputFile(img_data, f"whoami.{image_ext(img_data)}"),
+        caption=caption,
+        parse_mode=None
+    )
+
+
+# ─────────── Кэш /proof ───────────
+# нормализованный текст → готовый ответ
+proof_answers = TTLCache("proof_answers", PROOF_CACHE_TTL, max_entries=PROOF_CACHE_MAX_ENTRIES)
+# нормализованный текст → очищенный поисковый запрос
+proof_queries = TTLCache("proof_queries", PROOF_QUERY_CACHE_TTL, max_entries=PROOF_CACHE_MAX_ENTRIES)
+# нормализованный запрос → результаты Google Search
+proof_searches = TTLCache("proof_searches", PROOF_CACHE_TTL, max_entries=PROOF_CACHE_MAX_ENTRIES)
+
+
+def normalize_proof_text(text: str) -> str:
+    """Приводит текст к виду, одинаковому для пересланных копий одного сообщения."""
+    return " ".join(text.casefold().split())
+
+
+def proof_cache_stats() -> dict:
+    return {
+        "answers": proof_answers.stats(),
+        "queries": proof_queries.stats(),
+        "searches": proof_searches.stats(),
+    }
+
+
+async def send_proof_answer(message: types.Message, final: str):
+    """Отправляет ответ /proof частями по 4096 символов, при ошибке HTML — текстом."""
+    LIMIT = 4096
+    try:
+        if len(final) > LIMIT:
+            for i in range(0, len(final), LIMIT):
+                await message.answer(final[i:i + LIMIT], parse_mode=ParseMode.HTML)
+        else:
+            await message.answer(final, parse_mode=ParseMode.HTML)
+    except TelegramBadRequest as e:
+        log.warning(f"Ошибка HTML: {e}. Отправляю как текст.")
+        if len(final) > LIMIT:
+            for i in range(0, len(final), LIMIT):
+                await message.answer(final[i:i + LIMIT], parse_mode=None)
+        else:
+            await message.answer(final, parse_mode=None)
+
+
+# Теги убираются из черновика, включая недописанный тег в конце
+HTML_TAG_RE = re.compile(r"<[^>]*(?:>|$)")
+
+
+def clean_proof_text(text: str) -> str:
+    return html.unescape(text).strip().replace('\\n', '\n')
+
+
+class ProofStreamWriter:
+    """
+    Показывает ответ /proof по мере генерации. Пока текст идёт, сообщение
+    правится не чаще раза в PROOF_STREAM_EDIT_INTERVAL секунд простым текстом;
+    как только набирается 4096 символов, часть фиксируется в HTML, а продолжение
+    пишется в новое сообщение. Черновики не задерживают чтение потока: пока
+    предыдущая правка ждёт в очереди исходящих, новая не ставится.
+    """
+
+    LIMIT = 4096
+
+    def __init__(self, message: types.Message, current: Optional[types.Message]):
+        self.message = message
+        self.current = current  # сообщение, которое сейчас дописывается
+        self.buffer = ""
+        self.pieces: List[str] = []
+        self._shown = ""
+        self._last_edit = 0.0
+        self._draft: Optional[asyncio.Task] = None
+
+    async def feed(self, delta: str):
+        self.buffer += delta
+        while len(self.buffer) > self.LIMIT:
+            cut = self.buffer.rfind("\n", 0, self.LIMIT)
+            if cut <= 0:
+                cut = self.LIMIT
+            piece, self.buffer = self.buffer[:cut], self.buffer[cut:].lstrip("\n")
+            await self._commit(piece)
+        if time.monotonic() - self._last_edit >= PROOF_STREAM_EDIT_INTERVAL:
+            self._preview()
+
+    def _preview(self):
+        if self._draft is not None and not self._draft.done():
+            return
+        text = clean_proof_text(HTML_TAG_RE.sub("", self.buffer))[:self.LIMIT - 2]
+        if not text or text == self._shown:
+            return
+        self._last_edit = time.monotonic()
+        self._shown = text
+        self._draft = asyncio.create_task(self._show_draft(text + " ▌"))
+
+    async def _show_draft(self, text: str):
+        try:
+            if self.current is None:
+                self.current = await self.message.answer(text, parse_mode=None)
+            else:
+                await self.current.edit_text(text, parse_mode=None)
+        except Exception as e:
+            log.debug(f"Не удалось обновить черновик ответа: {e}")
+
+    async def _settle(self):
+        """Дожидается отправленного черновика, чтобы сообщения не перепутались."""
+        if self._draft is not None:
+            await self._draft
+            self._draft = None
+
+    async def _commit(self, piece: str):
+        await self._settle()
+        final = clean_proof_text(piece)
+        if final:
+            self.pieces.append(final)
+            try:
+                await self._show(final, ParseMode.HTML)
+            except TelegramBadRequest as e:
+                log.warning(f"Ошибка HTML: {e}. Отправляю как текст.")
+                try:
+                    await self._show(final, None)
+                except TelegramBadRequest as e:
+                    log.warning(f"Не удалось отправить часть ответа: {e}")
+        self.current = None
+        self._shown = ""
+
+    async def _show(self, text: str, parse_mode):
+        if self.current is None:
+            await self.message.answer(text, parse_mode=parse_mode)
+        else:
+            await self.current.edit_text(text, parse_mode=parse_mode)
+
+    async def close(self, error: Optional[str] = None) -> str:
+        """Фиксирует остаток текста и возвращает весь ответ целиком."""
+        await self._settle()
+        if clean_proof_text(self.buffer):
+            await self._commit(self.buffer)
+        self.buffer = ""
+        if error or not self.pieces:
+            await self._show(error or "Не удалось получить ответ.", None)
+        return "\n".join(self.pieces)
+
+
+async def stream_proof_answer(
+    message: types.Message,
+    processing_msg: types.Message,
+    session: aiohttp.ClientSession,
+    original_query: str,
+    search_context: Optional[str],
+    timeout: float = 90
+) -> Tuple[str, bool]:
+    """Стримит ответ Gemini вместо processing_msg; возвращает текст и признак успеха."""
+    writer = ProofStreamWriter(message, processing_msg)
+    error = None
+    try:
+        async for delta in stream_summary_with_gemini(
+            session, original_query, search_context, timeout=timeout
+        ):
+            await writer.feed(delta)
+    except QuotaExceeded as e:
+        log.warning("Квота Gemini исчерпана")
+        error = str(e)
+    except aiohttp.ClientResponseError as e:
+        log.error(f"HTTP ошибка Gemini: {e}")
+        error = f"Ошибка API ({e.status})."
+    except Exception as e:
+        log.error(f"Ошибка Gemini: {e}", exc_info=True)
+        error = "Произошла ошибка при обработке запроса."
+
+    final = await writer.close(error)
+    log.info(f"Ответ Gemini (поток): {final[:100]}...")
+    return final, error is None and bool(final)
+
+
+class ProofDeadline:
+    """
+    Сквозной бюджет времени одного /proof. Этап получает не больше своего лимита
+    и не залезает в резерв, оставленный под ответ Gemini; длительности этапов
+    собираются для лога.
+    """
+
+    def __init__(self, total: float, reserve: float):
+        self.started = time.monotonic()
+        self.total = total
+        self.reserve = reserve
+        self.timings: Dict[str, float] = {}
+        self._stage_started = self.started
+
+    def remaining(self) -> float:
+        return max(0.0, self.started + self.total - time.monotonic())
+
+    def budget(self, cap: float) -> float:
+        return max(0.0, min(cap, self.remaining() - self.reserve))
+
+    def summary_timeout(self) -> float:
+        """
+        Таймаут ответа Gemini. Отправки в Telegram между этапами ни в какой бюджет
+        не входят и могут съесть резерв, а нулевой таймаут aiohttp означает «без
+        ограничения», поэтому меньше резерва (и меньше секунды) не даём.
+        """
+        return max(self.remaining(), self.reserve, 1.0)
+
+    def mark(self, stage: str):
+        now = time.monotonic()
+        self.timings[stage] = now - self._stage_started
+        self._stage_started = now
+
+    def summary(self) -> str:
+        stages = " ".join(f"{name}={sec:.2f}s" for name, sec in self.timings.items())
+        return f"{stages} total={time.monotonic() - self.started:.2f}s"
+
+
+# Загрузки страниц, которых ответ не дождался: доживают в фоне и наполняют кэш страниц
+background_fetches: set = set()
+
+
+async def collect_sources(session: aiohttp.ClientSession, urls: List[str], budget: float) -> List[str]:
+    """
+    Загружает страницы параллельно, но не дольше budget секунд. Если через
+    PROOF_HEDGE_AFTER секунд хотя бы одна страница готова, медленные не ждутся.
+    Для недождавшихся страниц возвращается пустая строка.
+    """
+    tasks = [asyncio.ensure_future(fetch_and_parse_url(session, url)) for url in urls]
+    started = time.monotonic()
+    pending = set(tasks)
+    while pending:
+        elapsed = time.monotonic() - started
+        if elapsed >= budget:
+            break
+        ready = any(t.done() and t.result() for t in tasks)
+        if ready and elapsed >= PROOF_HEDGE_AFTER:
+            break
+        limit = min(PROOF_HEDGE_AFTER, budget) if ready else budget
+        _, pending = await asyncio.wait(
+            pending, timeout=limit - elapsed, return_when=asyncio.FIRST_COMPLETED
+        )
+
+    if pending:
+        log.info(f"/proof: {len(pending)} из {len(tasks)} страниц не дождались, догружаются в фоне")
+        for task in pending:
+            background_fetches.add(task)
+            task.add_done_callback(background_fetches.discard)
+    return [t.result() if t.done() else "" for t in tasks]
 
 
 # ─────────── Команда /proof ───────────
@@ -780,70 +3391,121 @@ async def proof_command_handler(message: types.Message, command: CommandObject):
         )
         return
 
+    norm_text = normalize_proof_text(text_to_proof)
+    cached = proof_answers.get(norm_text)
+    if cached is not None:
+        log.info(f"/proof: ответ из кэша ({len(cached)} символов)")
+        await send_proof_answer(message, cached)
+        return
+
+    # Без ответа Gemini поиск бесполезен — квоту Google не тратим
+    if quotas.would_exceed("gemini_text"):
+        await message.reply(GEMINI_QUOTA_MSG, parse_mode=None)
+        return
+
     can_search = GOOGLE_API_KEY and GOOGLE_CSE_ID
     search_context = None
+    deadline = ProofDeadline(PROOF_DEADLINE, PROOF_SUMMARY_RESERVE)
 
-    async with aiohttp.ClientSession() as session:
-        if can_search:
+    session = get_http_session()
+    if can_search:
+        clean_query = proof_queries.get(norm_text)
+        results = None
+        if clean_query is not None:
+            results = proof_searches.get(normalize_proof_text(clean_query))
+
+        # Квота тратится только тогда, когда действительно нужен запрос в Google
+        if results is None:
             is_ok, limit_msg = await check_api_limit_and_increment()
             if not is_ok:
                 await message.reply(limit_msg, parse_mode=None)
                 return
 
-            processing_msg = await message.reply("Формирую запрос...", parse_mode=None)
-
-            clean_query = await get_clean_search_query(session, text_to_proof)
-            log.info(f"Очищенный запрос: '{clean_query}'")
+        processing_msg = await message.reply("Формирую запрос...", parse_mode=None)
 
+        if clean_query is None:
+            try:
+                clean_query = await asyncio.wait_for(
+                    get_clean_search_query(session, text_to_proof),
+                    deadline.budget(PROOF_QUERY_BUDGET)
+                )
+            except asyncio.TimeoutError:
+                log.warning("/proof: очистка запроса не уложилась в бюджет, ищу по исходному тексту")
+                clean_query = text_to_proof
+            # При ошибке Gemini возвращается исходный текст — такое не кэшируем
+            if clean_query != text_to_proof:
+                proof_queries.set(norm_text, clean_query)
+        log.info(f"Очищенный запрос: '{clean_query}'")
+        deadline.mark("query")
+
+        if results is None:
             await processing_msg.edit_text(f"Ищу: \"{clean_query}\"...", parse_mode=None)
-            results = await search_google(session, clean_query)
-
+            try:
+                results = await asyncio.wait_for(
+                    search_google(session, clean_query), deadline.budget(PROOF_SEARCH_BUDGET)
+                )
+            except asyncio.TimeoutError:
+                log.warning("/proof: поиск не уложился в бюджет, отвечаю без источников")
+                results = []
+            # Пустой список может означать и ошибку поиска, поэтому кэшируется только выдача
             if results:
-                await processing_msg.edit_text("Анализирую страницы...", parse_mode=None)
-
-                tasks = [fetch_and_parse_url(session, r['link']) for r in results]
-                contents = await asyncio.gather(*tasks)
-
-                parts = []
-                for i, (result, content) in enumerate(zip(results, contents)):
-                    if content:
-                        parts.append(
-                            f"<b>Источник {i + 1}:</b> "
-                            f"<a href='{result['link']}'>{html.escape(result['title'])}</a>\n"
-                            f"<i>Сниппет:</i> {html.escape(result.get('snippet', ''))}\n"
-                            f"<b>Текст:</b>\n{html.escape(content[:1500])}...\n"
-                        )
-                search_context = "\n\n---\n\n".join(parts) if parts else None
+                proof_searches.set(normalize_proof_text(clean_query), results)
         else:
-            log.info("Google Search не настроен. Анализ без поиска.")
-            processing_msg = await message.reply("Анализирую...", parse_mode=None)
+            log.info(f"/proof: выдача из кэша для '{clean_query}'")
+        deadline.mark("search")
+
+        if results:
+            await processing_msg.edit_text("Анализирую страницы...", parse_mode=None)
+
+            contents = await collect_sources(
+                session, [r['link'] for r in results], deadline.budget(PROOF_FETCH_BUDGET)
+            )
+
+            parts = []
+            for i, (result, content) in enumerate(zip(results, contents)):
+                if content:
+                    parts.append(
+                        f"<b>Источник {i + 1}:</b> "
+                        f"<a href='{result['link']}'>{html.escape(result['title'])}</a>\n"
+                        f"<i>Сниппет:</i> {html.escape(result.get('snippet', ''))}\n"
+                        f"<b>Текст:</b>\n{html.escape(content[:PROOF_SOURCE_CHARS])}...\n"
+                    )
+            search_context = "\n\n---\n\n".join(parts) if parts else None
+            deadline.mark("fetch")
+    else:
+        log.info("Google Search не настроен. Анализ без поиска.")
+        processing_msg = await message.reply("Анализирую...", parse_mode=None)
+
+    await processing_msg.edit_text("Формирую ответ...", parse_mode=None)
+    if PROOF_STREAM:
+        final, answer_ok = await stream_proof_answer(
+            message, processing_msg, session, text_to_proof, search_context,
+            timeout=deadline.summary_timeout()
+        )
+        deadline.mark("summary")
+        log.info(f"/proof тайминги: {deadline.summary()}")
+        if answer_ok:
+            proof_answers.set(norm_text, final)
+        return
 
-        await processing_msg.edit_text("Формирую ответ...", parse_mode=None)
-        answer = await summarize_with_gemini(session, text_to_proof, search_context)
+    answer, answer_ok = await summarize_with_gemini(
+        session, text_to_proof, search_context, timeout=deadline.summary_timeout()
+    )
+    deadline.mark("summary")
+    log.info(f"/proof тайминги: {deadline.summary()}")
 
     log.info(f"Ответ Gemini: {answer[:100]}...")
 
-    final = html.unescape(answer).strip().replace('\\n', '\n')
+    final = clean_proof_text(answer)
     await processing_msg.delete()
 
     if not final:
         await message.answer("Не удалось получить ответ.", parse_mode=None)
         return
 
-    LIMIT = 4096
-    try:
-        if len(final) > LIMIT:
-            for i in range(0, len(final), LIMIT):
-                await message.answer(final[i:i + LIMIT], parse_mode=ParseMode.HTML)
-        else:
-            await message.answer(final, parse_mode=ParseMode.HTML)
-    except TelegramBadRequest as e:
-        log.warning(f"Ошибка HTML: {e}. Отправляю как текст.")
-        if len(final) > LIMIT:
-            for i in range(0, len(final), LIMIT):
-                await message.answer(final[i:i + LIMIT], parse_mode=None)
-        else:
-            await message.answer(final, parse_mode=None)
+    if answer_ok:
+        proof_answers.set(norm_text, final)
+    await send_proof_answer(message, final)
 
 
 # ─────────── Обработчик добавления в чат ───────────
@@ -853,66 +3515,138 @@ async def added(ev: ChatMemberUpdated):
 
 
 # ─────────── Inline-режим ───────────
+# uid → (значения, готовые статьи) на время жизни профиля
+inline_results = TTLCache("inline", TTL_SECONDS, max_entries=INLINE_CACHE_MAX_ENTRIES)
+# uid → id последнего inline-запроса; более старые запросы не отвечаются
+inline_latest: Dict[int, str] = {}
+inline_dropped = 0
+
+
+def inline_article(uid: int, id_suffix: str, title: str, text: str, desc: str = None):
+    final_id = hashlib.md5(
+        f"{uid}_{id_suffix}_{hashlib.md5(text.encode()).hexdigest()}".encode()
+    ).hexdigest()
+    return InlineQueryResultArticle(
+        id=final_id,
+        title=title,
+        input_message_content=InputTextMessageContent(message_text=text),
+        description=desc
+    )
+
+
+def profile_articles(uid: int, p: Profile) -> list:
+    """Пять статей с характеристиками — строятся один раз на окно TTL."""
+    cached = inline_results.get(uid)
+    if cached is not None and cached[0] == p.stats:
+        return cached[1]
+
+    w, c, iq, h = p.stats
+    wt, ct, iqt, ht = p.wt, p.ct, p.iqt, p.ht
+    articles = [
+        inline_article(uid, "w", "Вес", f"Мой вес: {w} кг {wt}"),
+        inline_article(uid, "c", "Мой хуй", f"Мой хуй: {c} см {ct}"),
+        inline_article(uid, "i", "IQ", f"Мой IQ: {iq} {iqt}"),
+        inline_article(uid, "h", "Рост", f"Мой рост: {h} см {ht}"),
+        inline_article(uid, "all", "Хто я?",
+                       f"Мой вес: {w} кг {wt}\nМой хуй: {c} см {ct}\n"
+                       f"Мой IQ: {iq} {iqt}\nМой рост: {h} см {ht}",
+                       desc="Сводка характеристик"),
+    ]
+    inline_results.set(uid, (p.stats, articles), expires_at=p.expires_at)
+    return articles
+
+
 @dp.inline_query()
 async def inline(q: types.InlineQuery):
-    global BOT_USERNAME
-
-    if not BOT_USERNAME:
-        try:
-            me = await bot.get_me()
-            BOT_USERNAME = me.username or "bot"
-        except Exception as e:
-            log.error(f"Ошибка получения имени бота: {e}")
-            BOT_USERNAME = "bot"
+    global BOT_USERNAME, inline_dropped
 
     uid = q.from_user.id
     query_text = q.query.strip()
+    inline_latest[uid] = q.id
 
-    def art(id_suffix: str, title: str, text: str, desc: str = None):
-        final_id = hashlib.md5(
-            f"{uid}_{id_suffix}_{hashlib.md5(text.encode()).hexdigest()}".encode()
-        ).hexdigest()
-        return InlineQueryResultArticle(
-            id=final_id,
-            title=title,
-            input_message_content=InputTextMessageContent(message_text=text),
-            description=desc
-        )
+    try:
+        if not BOT_USERNAME:
+            try:
+                me = await bot.get_me()
+                BOT_USERNAME = me.username or "bot"
+            except Exception as e:
+                log.error(f"Ошибка получения имени бота: {e}")
+                BOT_USERNAME = "bot"
+
+        p = await get_profile(uid)
+        # С локальным состоянием get_profile не уступает управление — даём
+        # выполниться остальным апдейтам той же пачки getUpdates
+        await asyncio.sleep(0)
+
+        # Пока ждали, пользователь набрал следующий символ — этот запрос уже не нужен
+        if inline_latest.get(uid) != q.id:
+            inline_dropped += 1
+            return
+
+        results = list(profile_articles(uid, p))
+
+        if query_text:
+            short = html.escape(query_text[:40])
+            ellipsis = '...' if len(query_text) > 40 else ''
+            results.append(inline_article(
+                uid,
+                "proof_query",
+                f"Искать: \"{short}{ellipsis}\"",
+                f"/proof {query_text}",
+                desc="Отправить запрос боту"
+            ))
+        else:
+            results.append(inline_article(
+                uid,
+                "proof_help",
+                "Пруф? (Как использовать)",
+                f"Используйте /proof в чате с @{BOT_USERNAME}",
+                desc="Инструкция"
+            ))
+
+        # Telegram кэширует ответ до конца окна — повторные запросы до нас не доходят
+        cache_time = max(1, int(p.expires_at - time.time()))
+        await q.answer(results, cache_time=cache_time, is_personal=True)
+    finally:
+        if inline_latest.get(uid) == q.id:
+            del inline_latest[uid]
+
+
+def inline_stats() -> dict:
+    return {**inline_results.stats(), "pending": len(inline_latest), "dropped": inline_dropped}
+
+
+# ─────────── Метрики ───────────
+# Источники метрик: имя → функция, возвращающая словарь счётчиков
+METRICS: Dict[str, Callable[[], dict]] = {
+    "http_pool": http_pool_stats,
+    "stats_cache": cache.stats,
+    "img_cache": img_cache.stats,
+    "avatar_flight": avatar_flight.stats,
+    "avatar_queue": avatar_queue.stats,
+    "prefetch": prefetcher.stats,
+    "state_persister": state_persister.stats,
+    "inline": inline_stats,
+    "shared_state": shared_state.stats,
+    "cpu_pool": cpu_pool.stats,
+    "image_decode": lambda: dict(image_decode_peaks),
+    "outbox": outbox.stats,
+    "quotas": quotas.stats,
+    "proof_cache": proof_cache_stats,
+    "page_cache": page_cache.stats,
+    "page_failures": page_failures.stats,
+}
 
-    w, wt = await cached_val(uid, "weight")
-    c, ct = await cached_val(uid, "cock")
-    iq, iqt = await cached_val(uid, "iq")
-    h, ht = await cached_val(uid, "height")
-
-    results = [
-        art("w", "Вес", f"Мой вес: {w} кг {wt}"),
-        art("c", "Мой хуй", f"Мой хуй: {c} см {ct}"),
-        art("i", "IQ", f"Мой IQ: {iq} {iqt}"),
-        art("h", "Рост", f"Мой рост: {h} см {ht}"),
-        art("all", "Хто я?",
-            f"Мой вес: {w} кг {wt}\nМой хуй: {c} см {ct}\n"
-            f"Мой IQ: {iq} {iqt}\nМой рост: {h} см {ht}",
-            desc="Сводка характеристик"),
-    ]
 
-    if query_text:
-        short = html.escape(query_text[:40])
-        ellipsis = '...' if len(query_text) > 40 else ''
-        results.append(art(
-            "proof_query",
-            f"Искать: \"{short}{ellipsis}\"",
-            f"/proof {query_text}",
-            desc="Отправить запрос боту"
-        ))
-    else:
-        results.append(art(
-            "proof_help",
-            "Пруф? (Как использовать)",
-            f"Используйте /proof в чате с @{BOT_USERNAME}",
-            desc="Инструкция"
-        ))
+def collect_metrics() -> dict:
+    return {name: source() for name, source in METRICS.items()}
+
 
-    await q.answer(results, cache_time=1, is_personal=True)
+async def log_metrics_periodically():
+    """Периодически пишет метрики в лог."""
+    while True:
+        await asyncio.sleep(METRICS_LOG_INTERVAL)
+        log.info(f"Метрики: {json.dumps(collect_metrics(), ensure_ascii=False)}")
 
 
 # ─────────── Graceful shutdown ───────────
@@ -925,12 +3659,92 @@ async def shutdown_handler(sig: signal.Signals):
 
 
 # ─────────── Запуск ───────────
+async def run_polling():
+    await bot.delete_webhook(drop_pending_updates=True)
+
+    # Polling с graceful shutdown
+    polling_task = asyncio.create_task(dp.start_polling(bot))
+
+    # Ждём сигнал завершения или окончание polling
+    done, pending = await asyncio.wait(
+        [polling_task, asyncio.create_task(shutdown_event.wait())],
+        return_when=asyncio.FIRST_COMPLETED
+    )
+
+    # Отменяем pending задачи
+    for task in pending:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+async def run_webhook():
+    """
+    Webhook-режим: обновления принимает встроенный aiohttp-сервер.
+    Telegram сразу получает 200, обработка идёт в фоновых задачах.
+    """
+    app = web.Application()
+    handler = SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=WEBHOOK_SECRET
+    )
+    handler.register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    # reuse_port позволяет нескольким процессам-воркерам слушать один порт
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=WEBHOOK_REUSE_PORT)
+    await site.start()
+
+    url = WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH
+    # Очередь обновлений не сбрасываем: Telegram копит их, пока бот перезапускается
+    await bot.set_webhook(
+        url,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    log.info(f"Webhook: {url} (слушаю {WEBHOOK_HOST}:{WEBHOOK_PORT})")
+
+    try:
+        await shutdown_event.wait()
+    finally:
+        # Перестаём принимать запросы и даём дообработаться уже принятым
+        await site.stop()
+        in_flight = getattr(handler, "_background_feed_update_tasks", set())
+        if in_flight:
+            log.info(f"Ожидание {len(in_flight)} обновлений в обработке...")
+            await asyncio.wait(set(in_flight), timeout=WEBHOOK_DRAIN_TIMEOUT)
+        await runner.cleanup()
+
+
 async def main():
     global BOT_USERNAME
 
     # Загружаем кэш с диска
     load_cache_from_disk()
 
+    # Общий HTTP-пул для всех исходящих запросов
+    get_http_session()
+    metrics_task = (
+        asyncio.create_task(log_metrics_periodically())
+        if METRICS_LOG_INTERVAL > 0 else None
+    )
+    sweeper_task = asyncio.create_task(
+        sweep_caches_periodically(
+            cache, img_cache, inline_results, upcoming_profiles, active_users,
+            proof_answers, proof_queries, proof_searches, page_failures
+        )
+    )
+    persister_task = asyncio.create_task(state_persister.run())
+    avatar_queue.start()
+    prefetch_task = asyncio.create_task(prefetcher.run()) if PREFETCH_LEAD > 0 else None
+    compact_task = asyncio.create_task(compact_state_periodically())
+
     # Обработка сигналов для graceful shutdown
     loop = asyncio.get_event_loop()
     if sys.platform != "win32":
@@ -958,27 +3772,29 @@ async def main():
         scope=BotCommandScopeDefault()
     )
 
-    await bot.delete_webhook(drop_pending_updates=True)
-
-    # Polling с graceful shutdown
-    polling_task = asyncio.create_task(dp.start_polling(bot))
-
-    # Ждём сигнал завершения или окончание polling
-    done, pending = await asyncio.wait(
-        [polling_task, asyncio.create_task(shutdown_event.wait())],
-        return_when=asyncio.FIRST_COMPLETED
-    )
-
-    # Отменяем pending задачи
-    for task in pending:
-        task.cancel()
-        try:
-            await task
-        except asyncio.CancelledError:
-            pass
-
-    # Сохраняем кэш перед выходом
-    await save_cache_to_disk()
+    if BOT_MODE == "webhook":
+        await run_webhook()
+    else:
+        await run_polling()
+
+    if metrics_task:
+        metrics_task.cancel()
+    sweeper_task.cancel()
+    if prefetch_task:
+        prefetch_task.cancel()
+    await avatar_queue.close()
+
+    # Сохраняем кэш перед выходом (дожидаясь текущей фоновой записи)
+    compact_task.cancel()
+    await state_persister.flush()
+    persister_task.cancel()
+    state_store.close()
+    page_cache.close()
+    await shared_state.close()
+    await outbox.close()
+    cpu_pool.shutdown()
+    log.info(f"HTTP-пул: {http_pool_stats()}")
+    await close_http_session()
     log.info("Кэш сохранён. Бот остановлен.")
 
 